@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+"""A fake Plex Media Server with a synthetic library.
+
+It serves just enough of the PMS api for plexcli: the sections, paged
+listings with the filters we use, batched metadata, hub search, deletes,
+scrobble, sessions and part downloads with Range support. Every request is
+counted by endpoint and can be slowed down to act like a server far away.
+
+The notification websocket only sends, play() and the terminate endpoint
+send the playing notifications PMS would. stop() drops the websockets like
+a PMS restart and start() comes back on the same port.
+
+plexapi has plex.tv hardcoded, so instead of faking plex.tv we hand the
+cli a resource cache that points to the fake servers, see resource().
+"""
+
+import base64
+import hashlib
+import json
+import random
+import re
+import socket
+import struct
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, unquote_plus
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+    from urllib import unquote_plus
+
+
+MOVIES = 1
+SHOWS = 2
+EPISODES_PER_SHOW = 20
+GENRES = ('Action', 'Comedy', 'Drama', 'Family', 'Documentary')
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# Query params that are not filters.
+IGNORED = ('type', 'duplicate', 'query', 'limit', 'includeGuids', 'includeMeta', 'includeAdvanced', 'sort')
+
+
+class Library(object):
+    """A synthetic library, the same seed gives the same library.
+
+       Args:
+            items (int): Number of movies and episodes, about half of each.
+            duplicates (float): Part of the items with a second version.
+            watched (float): Part of the items that are watched.
+            guid_offset (int): Shift the guids, two libraries with a offset of
+                               100 has all but 100 items in common.
+            seed (int): For the random generator.
+    """
+    def __init__(self, items=1000, duplicates=0.05, watched=0.5, guid_offset=0, seed=1):
+        rnd = random.Random(seed)
+        self.items = {}
+        self.shows = {}
+        now = int(time.time())
+        movies = items // 2
+        media_id = 1
+
+        key = 1
+        for n in range(items):
+            g = n + guid_offset
+            seen = rnd.random() < watched
+            item = {'ratingKey': key, 'guid': 'plex://item/%s' % g, 'title': 'Item %s' % g,
+                    'year': 1950 + g % 70, 'addedAt': now - rnd.randint(0, 10 ** 8),
+                    'updatedAt': now - rnd.randint(0, 10 ** 7), 'rating': round(rnd.uniform(1, 10), 1),
+                    'viewCount': 1 if seen else 0, 'lastViewedAt': now - rnd.randint(0, 10 ** 7) if seen else None,
+                    'genre': GENRES[g % len(GENRES)], 'media': []}
+            if n < movies:
+                item.update(type='movie', section=MOVIES)
+            else:
+                e = n - movies
+                show = 10 ** 7 + e // EPISODES_PER_SHOW
+                if show not in self.shows:
+                    self.shows[show] = {'ratingKey': show, 'type': 'show', 'title': 'Show %s' % show,
+                                        'guid': 'plex://show/%s' % show, 'genre': GENRES[show % len(GENRES)],
+                                        'childCount': EPISODES_PER_SHOW // 10, 'leafCount': EPISODES_PER_SHOW}
+                item.update(type='episode', section=SHOWS, grandparentTitle=self.shows[show]['title'],
+                            grandparentRatingKey=show, parentIndex=1 + e % EPISODES_PER_SHOW // 10,
+                            index=1 + e % 10)
+
+            for _ in range(2 if rnd.random() < duplicates else 1):
+                item['media'].append({'id': media_id, 'size': rnd.randint(10 ** 8, 10 ** 10),
+                                      'file': '/data/%s/%s.mkv' % (item['type'], media_id),
+                                      'lang': rnd.choice(('eng', 'nor'))})
+                media_id += 1
+
+            self.items[key] = item
+            key += 1
+
+
+def _video(item, full=False):
+    tag = 'Directory' if item['type'] == 'show' else 'Video'
+    el = ElementTree.Element(tag, dict((k, str(v)) for k, v in item.items()
+                                       if v is not None and not isinstance(v, (list, dict)) and
+                                       k not in ('genre', 'section')))
+    el.set('key', '/library/metadata/%s' % item['ratingKey'])
+    if 'section' in item:
+        el.set('librarySectionID', str(item['section']))
+    if full or item['type'] != 'episode':
+        ElementTree.SubElement(el, 'Genre', tag=item['genre'])
+
+    for m in item.get('media', []):
+        media = ElementTree.SubElement(el, 'Media', id=str(m['id']), videoResolution='1080', container='mkv')
+        part = ElementTree.SubElement(media, 'Part', id=str(m['id']), file=m['file'], size=str(m['size']),
+                                      container='mkv', key='/library/parts/%s/file.mkv' % m['id'])
+        if full:
+            ElementTree.SubElement(part, 'Stream', id=str(m['id']), streamType='2', languageCode=m['lang'])
+    return el
+
+
+def _session(key, session, item):
+    el = _video(item)
+    el.set('sessionKey', key)
+    el.set('viewOffset', '0')
+    for media in el.findall('Media'):
+        media.set('videoResolution', session['resolution'])
+    ElementTree.SubElement(el, 'User', id='1', title=session['user'])
+    ElementTree.SubElement(el, 'Player', title='tv', machineIdentifier='player-%s' % key, state='playing',
+                           local='1' if session['local'] else '0')
+    ElementTree.SubElement(el, 'Session', id='session-%s' % key, bandwidth='4000',
+                           location='lan' if session['local'] else 'wan')
+    ElementTree.SubElement(el, 'TranscodeSession', key='/transcode/sessions/%s' % key,
+                           videoDecision='transcode' if session['transcode'] else 'copy')
+    return el
+
+
+def _filters(query):
+    """(field, op, value) from the query string, op is = or >."""
+    result = []
+    for k, v in query:
+        if k.endswith('>>') or k.endswith('>'):
+            result.append((k.rstrip('>'), '>', v))
+        elif k not in IGNORED and not k.startswith('X-Plex'):
+            result.append((k, '=', v))
+    return result
+
+
+class FakePlex(object):
+    """Serve a library over http on localhost.
+
+       Args:
+            library (Library): What to serve.
+            latency (float): Sec each request is delayed.
+            name (str): friendlyName, the machineIdentifier is based on it.
+            blob_size (int): Bytes served for every part download.
+    """
+    def __init__(self, library=None, latency=0, name='fake', blob_size=1024 * 1024):
+        self.library = library or Library()
+        self.latency = latency
+        self.name = name
+        self.machineIdentifier = 'fake-%s' % name
+        self.blob = bytes(bytearray(i % 251 for i in range(blob_size)))
+        self.requests = {}
+        self.bytes = 0
+        # sessionKey -> what's playing, see play().
+        self.sessions = {}
+        self.port = 0
+        self._lock = threading.Lock()
+        self._server = None
+        # Every open connection and the websockets among them.
+        self._connections = set()
+        self._sockets = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.port
+
+    def resource(self, token='token'):
+        """The resource dict for the plexcli resource cache."""
+        return {'name': self.name, 'clientIdentifier': self.machineIdentifier, 'accessToken': token,
+                'owned': True, 'uri': self.url, 'connections': [{'uri': self.url, 'local': True, 'relay': False}]}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # The headers and the body are separate writes, without this
+            # every keep-alive request waits for a delayed ack.
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with fake._lock:
+                    fake._connections.add(self.connection)
+
+            def finish(self):
+                with fake._lock:
+                    fake._connections.discard(self.connection)
+                BaseHTTPRequestHandler.finish(self)
+
+            def do_GET(self):
+                if self.headers.get('Upgrade', '').lower() == 'websocket':
+                    fake._websocket(self)
+                else:
+                    fake._handle(self, 'GET')
+
+            def do_DELETE(self):
+                fake._handle(self, 'DELETE')
+
+            def do_PUT(self):
+                fake._handle(self, 'PUT')
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        Server.allow_reuse_address = True
+        self._server = Server(('127.0.0.1', self.port), Handler)
+        self.port = self._server.server_port
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        # Kept alive connections would still be served otherwise.
+        with self._lock:
+            sockets, self._sockets = list(self._connections), []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+
+    def play(self, key, ratingKey, user, local=True, resolution='1080', transcode=False):
+        """Start a session and tell the websockets about it."""
+        self.sessions[str(key)] = {'ratingKey': ratingKey, 'user': user, 'local': local,
+                                   'resolution': resolution, 'transcode': transcode}
+        self.notify(key, 'playing')
+
+    def notify(self, key, state):
+        """Send a playing notification to every websocket."""
+        data = {'NotificationContainer': {'type': 'playing', 'size': 1, 'PlaySessionStateNotification': [
+            {'sessionKey': str(key), 'state': state, 'viewOffset': 0}]}}
+        payload = json.dumps(data).encode('utf-8')
+        if len(payload) < 126:
+            frame = struct.pack('!BB', 0x81, len(payload))
+        else:
+            frame = struct.pack('!BBH', 0x81, 126, len(payload))
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.sendall(frame + payload)
+            except (IOError, OSError):
+                pass
+
+    def _websocket(self, handler):
+        """Accept the websocket and wait for the client to close it."""
+        self._count('GET %s' % urlsplit(handler.path).path, 0)
+        accept = hashlib.sha1((handler.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode('ascii')).digest()
+        handler.send_response(101)
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', base64.b64encode(accept).decode('ascii'))
+        handler.end_headers()
+        handler.wfile.flush()
+        with self._lock:
+            self._sockets.append(handler.connection)
+
+        try:
+            # The client only sends close and maybe a ping, masked frames
+            # with short payloads.
+            while True:
+                head = bytearray(handler.rfile.read(2))
+                if len(head) < 2:
+                    break
+                opcode, size = head[0] & 0x0f, head[1] & 0x7f
+                if size == 126:
+                    size = struct.unpack('!H', handler.rfile.read(2))[0]
+                elif size == 127:
+                    size = struct.unpack('!Q', handler.rfile.read(8))[0]
+                handler.rfile.read(4 + size)
+                if opcode == 0x8:
+                    handler.connection.sendall(b'\x88\x00')
+                    break
+                if opcode == 0x9:
+                    handler.connection.sendall(b'\x8a\x00')
+        except (IOError, OSError):
+            pass
+        finally:
+            with self._lock:
+                if handler.connection in self._sockets:
+                    self._sockets.remove(handler.connection)
+            handler.close_connection = True
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _count(self, endpoint, size):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes += size
+
+    def _handle(self, handler, method):
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlsplit(handler.path)
+        # Keep >= and >>= from the filters as they are.
+        query = [(unquote_plus(k), unquote_plus(v)) for k, _, v in
+                 (p.partition('=') for p in url.query.split('&') if p)]
+        path = url.path
+        status, body, ctype, headers = 200, b'', 'text/xml', {}
+
+        endpoint = re.sub(r'\d+(,\d+)*', '{}', path)
+        try:
+            if path.startswith('/library/parts/'):
+                status, body, headers = self._part(handler.headers.get('Range'))
+                ctype = 'video/x-matroska'
+            else:
+                status, root = self._route(method, path, dict(query), query, handler.headers)
+                body = ElementTree.tostring(root) if root is not None else b''
+        except KeyError:
+            status, body = 404, b''
+
+        self._count('%s %s' % (method, endpoint), len(body))
+        handler.send_response(status)
+        handler.send_header('Content-Type', ctype)
+        handler.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _part(self, rng):
+        if not rng:
+            return 200, self.blob, {}
+        start, end = [int(i) if i else None for i in rng.split('=')[1].split('-')]
+        end = len(self.blob) - 1 if end is None else min(end, len(self.blob) - 1)
+        return 206, self.blob[start:end + 1], {'Content-Range': 'bytes %s-%s/%s' % (start, end, len(self.blob))}
+
+    def _container(self, items, start=0, size=None, **attrib):
+        total = len(items)
+        page = items[start:] if size is None else items[start:start + size]
+        root = ElementTree.Element('MediaContainer', dict(attrib, size=str(len(page)), totalSize=str(total)))
+        for el in page:
+            root.append(el)
+        return root
+
+    def _meta(self, section):
+        """The filters plexapi validates search() against, we only have duplicate."""
+        root = ElementTree.Element('MediaContainer', size='0')
+        meta = ElementTree.SubElement(root, 'Meta')
+        for libtype in ('movie',) if section == MOVIES else ('show', 'episode'):
+            t = ElementTree.SubElement(meta, 'Type', key='/library/sections/%s/all' % section, type=libtype,
+                                       title=libtype, active='1')
+            ElementTree.SubElement(t, 'Field', key='duplicate', title='Duplicate', type='boolean')
+        ft = ElementTree.SubElement(meta, 'FieldType', type='boolean')
+        ElementTree.SubElement(ft, 'Operator', key='=', title='is')
+        return root
+
+    def _route(self, method, path, params, query, headers):
+        lib = self.library
+        if method == 'DELETE':
+            m = re.match(r'^/library/metadata/(\d+)(?:/media/(\d+))?$', path)
+            item = lib.items[int(m.group(1))]
+            if m.group(2):
+                item['media'] = [i for i in item['media'] if i['id'] != int(m.group(2))]
+                if not item['media']:
+                    del lib.items[item['ratingKey']]
+            else:
+                del lib.items[item['ratingKey']]
+            return 200, None
+
+        if path in ('/', '/identity'):
+            return 200, ElementTree.Element('MediaContainer', machineIdentifier=self.machineIdentifier,
+                                            friendlyName=self.name, version='1.40.0.0', myPlex='0')
+
+        if path == '/library':
+            return 200, ElementTree.Element('MediaContainer', title1='Plex Library')
+
+        if path in ('/library/sections', '/library/sections/all'):
+            return 200, self._container([
+                ElementTree.Element('Directory', key=str(MOVIES), type='movie', title='Movies',
+                                    agent='tv.plex.agents.movie', uuid='m'),
+                ElementTree.Element('Directory', key=str(SHOWS), type='show', title='TV Shows',
+                                    agent='tv.plex.agents.series', uuid='s')])
+
+        m = re.match(r'^/library/sections/(\d+)/(all|collections)$', path)
+        if m and params.get('includeMeta') == '1':
+            return 200, self._meta(int(m.group(1)))
+        if m:
+            section = int(m.group(1))
+            items = [i for i in lib.items.values() if i['section'] == section]
+            if section == SHOWS and params.get('type') != '4':
+                items = list(lib.shows.values())
+            for field, op, value in _filters(query):
+                if op == '>':
+                    items = [i for i in items if (i.get(field) or 0) > float(value)]
+                else:
+                    items = [i for i in items if str(i.get(field)) == value]
+            if params.get('duplicate') == '1':
+                items = [i for i in items if len(i['media']) > 1]
+            start = headers.get('X-Plex-Container-Start') or params.get('X-Plex-Container-Start') or 0
+            size = headers.get('X-Plex-Container-Size') or params.get('X-Plex-Container-Size')
+            return 200, self._container([_video(i) for i in items], int(start),
+                                        None if size is None else int(size), librarySectionID=str(section))
+
+        m = re.match(r'^/library/metadata/([\d,]+)$', path)
+        if m:
+            keys = [int(k) for k in m.group(1).split(',')]
+            found = [lib.items.get(k) or lib.shows.get(k) for k in keys]
+            found = [i for i in found if i is not None]
+            if not found:
+                raise KeyError(path)
+            return 200, self._container([_video(i, full=True) for i in found])
+
+        if path == '/hubs/search':
+            q = params.get('query', '').lower()
+            hub = ElementTree.Element('Hub', type='movie', hubIdentifier='movie', title='Movies')
+            for i in lib.items.values():
+                if i['type'] == 'movie' and q in i['title'].lower():
+                    hub.append(_video(i))
+            hub.set('size', str(len(hub)))
+            return 200, self._container([hub])
+
+        if path == '/:/scrobble':
+            item = lib.items[int(params['key'])]
+            item['viewCount'] = (item['viewCount'] or 0) + 1
+            item['lastViewedAt'] = int(time.time())
+            return 200, None
+
+        if path == '/status/sessions':
+            return 200, self._container([_session(k, s, lib.items[s['ratingKey']]) for k, s in sorted(self.sessions.items())])
+
+        if path == '/status/sessions/terminate':
+            for key in list(self.sessions):
+                if 'session-%s' % key == params.get('sessionId'):
+                    del self.sessions[key]
+                    self.notify(key, 'stopped')
+                    return 200, None
+            raise KeyError(params.get('sessionId'))
+
+        raise KeyError(path)
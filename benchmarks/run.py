@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""Run the plexcli commands against fake servers and save the numbers.
+
+Every benchmark gets fresh fake servers and runs in its own process, so the
+peak rss is for that command only. The questions are answered with yes and
+"all", so the commands that delete really delete (on the fake server).
+
+The startup benchmarks time a fresh python importing plexcli and showing
+the help, so a heavy import at the top of a module shows up as a regression.
+
+    python -m benchmarks.run --items 1000,10000 --latency 0.005 --out results.json
+    python -m benchmarks.run --items 1000 --compare results.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from benchmarks.fakeplex import FakePlex, Library
+
+
+BENCHMARKS = ('search', 'diff', 'sync', 'remove_dupes', 'delete_watched', 'download')
+# Slower than this compared to the old results counts as a regression.
+THRESHOLD = 1.5
+# Code run by a fresh python for the startup benchmarks.
+STARTUP = {'import': 'import plexcli.cli',
+           'help': 'import sys; sys.argv = ["plex-cli", "--help"]; from plexcli.cli import main; main()'}
+
+
+def _search(c, tmp):
+    c.search('Item 1')
+
+
+def _diff(c, tmp):
+    c.diff('a', 'b')
+
+
+def _sync(c, tmp):
+    c.sync(frm='a', too='b')
+
+
+def _remove_dupes(c, tmp):
+    c.remove_dupes(lang='xxx', ignore_category='')
+
+
+def _delete_watched(c, tmp):
+    c.delete_watched(server='a')
+
+
+def _download(c, tmp):
+    from plexcli.utils import _download
+    pms = c._get_server('a')
+    _download(pms.search('Item 1')[:10], os.path.join(tmp, 'downloads'))
+
+
+def _child(name, resources, tmp, queue):
+    """Runs in a new process, puts (wall, peak rss in kb, error) on queue."""
+    import click
+    from plexcli import cache, cli
+
+    # Answer yes and "everything" to every question.
+    click.confirm = lambda *args, **kwargs: True
+    click.prompt = lambda *args, **kwargs: ':'
+    cache.CACHE_DIR = os.path.join(tmp, 'cache')
+    cache.set_resources('bench', resources)
+
+    devnull = open(os.devnull, 'w')
+    sys.stdout = sys.stderr = devnull
+    error = None
+    start = time.time()
+    try:
+        globals()['_%s' % name](cli.CLI(username='bench', password='bench'), tmp)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    wall = time.time() - start
+    queue.put((wall, _peak_rss(), error))
+
+
+def _peak_rss():
+    """Peak rss of this process in kb."""
+    # ru_maxrss survives fork and exec, so it would include the parent and its
+    # libraries. VmHWM is for this process only.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on osx, kb everywhere else.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run(name, items=1000, latency=0, duplicates=0.05, watched=0.5):
+    """Run one benchmark, returns a dict with the numbers."""
+    servers = [FakePlex(Library(items, duplicates, watched), latency=latency, name='a'),
+               FakePlex(Library(items, duplicates, watched, guid_offset=items // 10, seed=2),
+                        latency=latency, name='b')]
+    tmp = tempfile.mkdtemp(prefix='plexcli-bench-')
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    try:
+        for s in servers:
+            s.start()
+
+        p = ctx.Process(target=_child, args=(name, [s.resource() for s in servers], tmp, queue))
+        p.start()
+        p.join()
+        try:
+            wall, peak, error = queue.get(timeout=5)
+        except Empty:
+            wall, peak, error = 0, None, 'The benchmark died with exit code %s' % p.exitcode
+    finally:
+        for s in servers:
+            s.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    requests = {}
+    for s in servers:
+        for endpoint, count in s.requests.items():
+            requests[endpoint] = requests.get(endpoint, 0) + count
+
+    return {'benchmark': name, 'items': items, 'latency': latency, 'duplicates': duplicates,
+            'watched': watched, 'wall': round(wall, 3), 'peak_rss_kb': peak,
+            'requests': sum(requests.values()), 'bytes': sum(s.bytes for s in servers),
+            'endpoints': requests, 'error': error}
+
+
+def startup(name, runs=5):
+    """Time a fresh python running STARTUP[name], the best of runs.
+
+       python is the time python itself needs to start, to see what's ours.
+    """
+    def best(code):
+        walls = []
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(runs):
+                start = time.time()
+                returncode = subprocess.call([sys.executable, '-c', code], stdout=devnull, stderr=devnull)
+                walls.append(time.time() - start)
+        return min(walls), returncode
+
+    wall, exit_code = best(STARTUP[name])
+    return {'benchmark': name, 'items': 0, 'latency': 0, 'wall': round(wall, 3),
+            'python': round(best('pass')[0], 3), 'peak_rss_kb': None, 'requests': 0, 'bytes': 0,
+            'endpoints': {}, 'error': 'exit code %s' % exit_code if exit_code else None}
+
+
+def compare(results, old):
+    """Returns the results that got slower then THRESHOLD times the old ones."""
+    before = dict(((r['benchmark'], r['items'], r['latency']), r) for r in old['results'])
+    slower = []
+    for r in results:
+        o = before.get((r['benchmark'], r['items'], r['latency']))
+        if o is None or not o['wall']:
+            continue
+        ratio = r['wall'] / o['wall']
+        print('%-15s %7s items %6.2fx wall, %s -> %s requests' % (r['benchmark'], r['items'], ratio,
+                                                                o['requests'], r['requests']))
+        if ratio > THRESHOLD:
+            slower.append(r)
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark plexcli against fake servers.')
+    parser.add_argument('--items', default='1000', help='Library sizes, comma separated.')
+    parser.add_argument('--latency', type=float, default=0, help='Sec added to every request.')
+    parser.add_argument('--duplicates', type=float, default=0.05)
+    parser.add_argument('--watched', type=float, default=0.5)
+    parser.add_argument('--only', help='Benchmarks to run, comma separated. %s and %s.' % (
+                        ', '.join(BENCHMARKS), ', '.join(sorted(STARTUP))))
+    parser.add_argument('--out', help='Save the results as json.')
+    parser.add_argument('--compare', help='Compare with results saved earlier, exits 1 on a regression.')
+    args = parser.parse_args(argv)
+
+    import plexapi
+    names = args.only.split(',') if args.only else BENCHMARKS + tuple(sorted(STARTUP))
+    results = []
+    for name in [n for n in names if n in STARTUP]:
+        r = startup(name)
+        results.append(r)
+        print('%-15s %13.3fs %.3fs python %s' % (name, r['wall'], r['python'], r['error'] or ''))
+
+    for items in [int(i) for i in args.items.split(',')]:
+        for name in [n for n in names if n not in STARTUP]:
+            r = run(name, items, args.latency, args.duplicates, args.watched)
+            results.append(r)
+            print('%-15s %7s items %8.2fs %7s requests %8s kb %s' % (name, items, r['wall'], r['requests'],
+                                                                    r['peak_rss_kb'], r['error'] or ''))
+
+    out = {'created': int(time.time()), 'python': platform.python_version(),
+           'plexapi': getattr(plexapi, 'VERSION', None), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)):
+                return 1
+    return 1 if any(r['error'] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
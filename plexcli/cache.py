@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""Small on disk cache so we dont have to ask plex.tv for everything on every run."""
+
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+
+
+CACHE_DIR = os.environ.get('PLEXCLI_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'plexcli')
+TOKENS = 'tokens.json'
+RESOURCES = 'resources.json'
+RESOURCE_TTL = 3600
+SYNC = 'sync.json'
+
+# The commands update the cache from many threads, every load, change and
+# save has to hold this or the updates of the other threads are lost.
+_lock = threading.RLock()
+
+
+def _path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def load(name, default=None):
+    """Load a json file from the cache dir, returns default if it's missing or broken."""
+    try:
+        with open(_path(name)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def save(name, data):
+    """Save data as json in the cache dir.
+
+       The cache holds tokens so both the dir and the file is only
+       readable by the owner. The file is written to a tmp file first
+       so a crash can't leave a half written cache behind, the tmp name is
+       unique so other plexcli processes dont write to it at the same time.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR, stat.S_IRWXU)
+
+    path = _path(name)
+    # mkstemp creates it readable by the owner only.
+    fd, tmp = tempfile.mkstemp(prefix='%s.' % name, suffix='.tmp', dir=CACHE_DIR)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+
+    os.chmod(tmp, stat.S_IRUSR | stat.S_IWUSR)
+    if os.path.exists(path) and os.name == 'nt':
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def get_token(username):
+    return load(TOKENS, {}).get(username)
+
+
+def set_token(username, token):
+    with _lock:
+        tokens = load(TOKENS, {})
+        tokens[username] = token
+        save(TOKENS, tokens)
+
+
+def del_token(username):
+    with _lock:
+        tokens = load(TOKENS, {})
+        if tokens.pop(username, None) is not None:
+            save(TOKENS, tokens)
+
+
+def get_resources(username, ttl=RESOURCE_TTL):
+    """Cached resources for username, None if they are missing or older than ttl."""
+    data = load(RESOURCES, {}).get(username)
+    if not data or time.time() - data['fetched'] > ttl:
+        return None
+    return data['resources']
+
+
+def set_resources(username, resources):
+    """Cache the resources for username, keeps the last uri that worked
+       and the connection scores as long as plex.tv still advertises them.
+    """
+    with _lock:
+        data = load(RESOURCES, {})
+        old = dict((r['clientIdentifier'], r) for r in data.get(username, {}).get('resources', []))
+        for resource in resources:
+            prev = old.get(resource['clientIdentifier'], {})
+            scores = dict((c['uri'], c) for c in prev.get('connections', []))
+            for connection in resource['connections']:
+                for k in ('latency', 'health'):
+                    if k in scores.get(connection['uri'], {}):
+                        connection[k] = scores[connection['uri']][k]
+
+            uri = prev.get('uri')
+            if uri and uri in [c['uri'] for c in resource['connections']]:
+                resource['uri'] = uri
+
+        data[username] = {'fetched': time.time(), 'resources': resources}
+        save(RESOURCES, data)
+
+
+def _update_resource(username, client_id, **changes):
+    with _lock:
+        data = load(RESOURCES, {})
+        for resource in data.get(username, {}).get('resources', []):
+            if resource['clientIdentifier'] == client_id:
+                resource.update(changes)
+                save(RESOURCES, data)
+                break
+
+
+def set_uri(username, client_id, uri):
+    """Remember the uri that worked for a server, None invalidates it."""
+    _update_resource(username, client_id, uri=uri)
+
+
+def set_connections(username, client_id, connections):
+    """Store the connections with their latency and health scores."""
+    _update_resource(username, client_id, connections=connections)
+
+
+def _mark_key(source, target, section):
+    return '%s|%s|%s' % (source, target, section)
+
+
+def get_mark(source, target, section):
+    """The newest lastViewedAt we have synced from source to target for a section."""
+    return load(SYNC, {}).get(_mark_key(source, target, section))
+
+
+def set_marks(source, target, marks):
+    """Store the high water marks, marks is a dict of section: lastViewedAt."""
+    with _lock:
+        data = load(SYNC, {})
+        for section, mark in marks.items():
+            data[_mark_key(source, target, section)] = mark
+        save(SYNC, data)
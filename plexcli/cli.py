@@ -2,20 +2,31 @@
 
 """Console script for plexcli."""
 
+import atexit
+import csv
+import json
 import os
 import logging
+import sys
+import time
 from functools import partial
 
 import click
-import fire
-from tqdm import tqdm
 
-from plexapi import CONFIG
-from plexapi.myplex import MyPlexAccount
-from plexapi.server import PlexServer
-from plexapi.video import Episode, Movie, Show
-
-from .utils import choose, convert_size, get_genre, prompt, select, _download
+# plexapi, requests, tqdm and fire are imported where they are used, they
+# take most of the startup time and help or browser dont need them.
+from . import cache, config, dedupe
+from .client import socket_path
+from .executor import AdaptiveExecutor
+from .index import Index
+from .instrument import Profiler
+from .monitor import SessionTable, listen, parse_rules, session_info, session_totals
+from .plan import DELETE_MEDIA, DELETE_WATCHED, apply_plan, op, read_done, read_plan, write_plan
+from .records import iter_records
+from .utils import (PAGE_SIZE, PRIORITIES, choose, compare, convert_size, fan_out, fetch_metadata,
+                    get_genre, guid_index, location, make_session, parse_list, parse_size,
+                    pick_free, probe, prompt, rank_connections, resource_to_dict, score, section_key, select,
+                    timestamp, _download)
 
 
 LOG = logging.getLogger(__file__)
@@ -26,61 +37,237 @@ click.prompt = partial(click.prompt, prompt_suffix='> ')
 
 
 class CLI():
-    """Simple cli for plex. --dry_run=True to test commands."""
-    def __init__(self, username=None, password=None, servername=None, debug=False, dry_run=False):
-        self._username = username or CONFIG.get('auth.myplex_username')
-        self._password = password or CONFIG.get('auth.myplex_password')
-        self._servername = servername or CONFIG.get('default.servername')
+    """Simple cli for plex. --dry_run=True to test commands.
+       --profile shows what the http requests cost when the command is done,
+       --profile=out.json saves it, --cprofile=out.prof saves cProfile stats too.
+    """
+    # The daemon sets this to a dict to keep the session, the account and
+    # the servers between commands.
+    _warm = None
+
+    def __init__(self, username=None, password=None, servername=None, debug=False, dry_run=False,
+                 cache_ttl=cache.RESOURCE_TTL, prefer=None, page_size=PAGE_SIZE, max_workers=8,
+                 profile=False, cprofile=None, pool_size=16, retries=3, backoff=0.5):
+        if profile or cprofile:
+            self._profile(profile, cprofile)
+
+        self._username = username or config.get('auth.myplex_username')
+        self._password = password or config.get('auth.myplex_password')
+        self._servername = servername or config.get('default.servername')
         self._dry_run = dry_run
-
-        if not self._username or not self._password:
-            self._username = click.prompt('Enter username')
-            self._password = click.prompt('Enter password')
+        self._cache_ttl = cache_ttl
+        # local, remote or relay
+        self._prefer = prefer or config.get('default.prefer')
+        self._page_size = page_size
+        # Max number of changes we make on a server at the same time.
+        self._max_workers = max_workers
+        self._pool = pool_size, retries, backoff
 
         if debug:
             logging.basicConfig(level=logging.DEBUG)
 
-        self.__account = MyPlexAccount(self._username, self._password)
+        # We only login when we have to, most commands can use the cache.
+        self.__account = None
 
-    def _get_server(self, servername=None, owned=False, msg='Select server'):
-        """Helper for servers."""
+    def _profile(self, out, cprofile_out):
+        profiler = Profiler(cprofile=bool(cprofile_out)).install()
+
+        def report():
+            table = profiler.report(out if isinstance(out, str) else None, cprofile_out)
+            if table:
+                click.echo(table, err=True)
+
+        if self._warm is not None:
+            # The daemon reports when the command is done.
+            self._warm.setdefault(('reports',), []).append(report)
+        else:
+            atexit.register(report)
+
+    def _keep(self, key, factory):
+        """factory() or what it made for a earlier command in the daemon."""
+        if self._warm is None:
+            return factory()
+        if key not in self._warm:
+            self._warm[key] = factory()
+        return self._warm[key]
+
+    def _http(self):
+        """Every server and plex.tv use the same connection pools."""
+        return self._keep(('session',) + self._pool, lambda: make_session(*self._pool))
+
+    def _get_account(self):
+        if self.__account is None:
+            # Asked here and not in __init__ so help and the cache dont need it.
+            if not self._username:
+                self._username = click.prompt('Enter username')
+            self.__account = self._keep(('account', self._username), self._login)
+        return self.__account
+
+    def _login(self):
+        """Login using the cached token, fall back to username and password
+           if we dont have a token or plex.tv rejects it.
+        """
+        from plexapi.exceptions import Unauthorized
+        from plexapi.myplex import MyPlexAccount
+
+        token = cache.get_token(self._username)
+        if token:
+            try:
+                return MyPlexAccount(token=token, session=self._http())
+            except Unauthorized:
+                LOG.debug('The cached token for %s was rejected', self._username)
+                cache.del_token(self._username)
+
+        if not self._password:
+            self._password = click.prompt('Enter password', hide_input=True)
+
+        account = MyPlexAccount(self._username, self._password, session=self._http())
+        cache.set_token(self._username, account.authenticationToken)
+        return account
+
+    def _resources(self, refresh=False):
+        """Server resources from the cache, asks plex.tv if the cache is stale."""
+        resources = None if refresh else cache.get_resources(self._username, self._cache_ttl)
+        if resources is None:
+            resources = [resource_to_dict(r) for r in self._get_account().resources()
+                         if 'server' in r.provides]
+            cache.set_resources(self._username, resources)
+
+        return resources
+
+    def _resource(self, name):
+        """Find a server resource by name, refresh the cache once if it's missing."""
+        for refresh in (False, True):
+            for resource in self._resources(refresh=refresh):
+                if name in (resource['name'], resource['clientIdentifier']):
+                    return resource
+
+        from plexapi.exceptions import NotFound
+        raise NotFound('Unable to find resource %s' % name)
+
+    def _race(self, resource, timeout=None, grace=0.25):
+        """Probe every connection of a resource at the same time and score them.
+
+           Returns the connections that answered, best first. We stop waiting
+           grace sec after the first answer, None waits for all of them.
+        """
+        connections = resource['connections']
+        if not connections:
+            return []
+
+        def ping(connection):
+            return probe(connection['uri'], resource['accessToken'], timeout=timeout or 5,
+                         session=self._http())
+
+        healthy = []
+        first = []
+
+        def late():
+            # The fastest answers first, give the rest a short grace
+            # period so the preferred location and health still count.
+            return grace is not None and bool(first) and time.time() - first[0] > grace
+
+        # fan_out checks late() while it waits too, a dead address would
+        # keep us waiting for the whole timeout otherwise.
+        for connection, latency, error in fan_out(ping, connections, workers=len(connections),
+                                                  timeout=timeout or 5, stop=late):
+            score(connection, None if error else latency)
+            if latency is not None and error is None:
+                healthy.append(connection)
+                if not first:
+                    first.append(time.time())
+
+            if late():
+                break
+
+        cache.set_connections(self._username, resource['clientIdentifier'], connections)
+        return rank_connections(healthy, self._prefer)
+
+    def _connect(self, resource, timeout=None):
+        """Connect to a server resource.
+
+           The uri that worked last time is tried first, if that fails it's
+           invalidated and we race all the connections of the server.
+        """
+        return self._keep(('server', self._username, resource['clientIdentifier']),
+                          lambda: self._connect_resource(resource, timeout))
+
+    def _connect_resource(self, resource, timeout=None):
+        from plexapi.exceptions import PlexApiException
+        from plexapi.server import PlexServer
+        from requests.exceptions import RequestException
+
+        if resource['uri']:
+            try:
+                return PlexServer(resource['uri'], resource['accessToken'], session=self._http(),
+                                  timeout=timeout)
+            except (RequestException, PlexApiException) as e:
+                LOG.debug('Failed to connect to %s using %s %s', resource['name'], resource['uri'], e)
+                cache.set_uri(self._username, resource['clientIdentifier'], None)
+
+        for connection in self._race(resource, timeout=timeout):
+            try:
+                pms = PlexServer(connection['uri'], resource['accessToken'], session=self._http(),
+                                 timeout=timeout)
+                cache.set_uri(self._username, resource['clientIdentifier'], connection['uri'])
+                return pms
+            except (RequestException, PlexApiException) as e:
+                LOG.debug('Failed to connect to %s using %s %s', resource['name'], connection['uri'], e)
+
+        # The token or the connections might have changed, let plexapi have a go.
+        pms = self._get_account().resource(resource['name']).connect(timeout=timeout)
+        cache.set_uri(self._username, resource['clientIdentifier'], pms._baseurl)
+        return pms
+
+    def _pick_resource(self, servername=None, owned=False, msg='Select server'):
+        """The resource of servername, or ask which one."""
         if servername:
-            return self.__account.resource(servername).connect()
+            return self._resource(servername)
 
-        servers = [s for s in self.__account.resources() if 'server' in s.provides]
+        servers = self._resources()
         if owned:
-            servers = [s for s in server is s.owned]
+            servers = [s for s in servers if s['owned']]
 
-        server = choose(msg, servers, 'name')
-        n = server[0].connect()
-        return n
+        server = choose(msg, servers, lambda s: s['name'])
+        return server[0]
+
+    def _get_server(self, servername=None, owned=False, msg='Select server'):
+        """Helper for servers."""
+        return self._connect(self._pick_resource(servername, owned, msg))
 
     def browser(self, servername=None):
         """Open the plex web interface in your default browser.
+           Opens the server url that worked last time, plex.tv is only
+           asked if the server isnt in the cache.
 
            Args:
                 servername (str): the server your want to use.
 
         """
-        # So it would be nice if we didnt have to login..
         name = servername or self._servername
+        # Any age will do, we only need the id and the uri.
+        cached = cache.get_resources(self._username, float('inf')) if self._username else None
         if name:
-            name = servername or self._servername
-            resource = self.__account.resource(name)
+            resource = next((r for r in cached or [] if name in (r['name'], r['clientIdentifier'])), None)
+            resource = resource or self._resource(name)
         else:
-            servers = [s for s in self.__account.resources() if 'server' in s.provides]
-            server = choose('Select server', servers, 'name')
+            server = choose('Select server', cached or self._resources(), lambda s: s['name'])
             resource = server[0]
 
-        url = 'https://app.plex.tv/desktop#!/server/%s?key=' % (resource.clientIdentifier)
+        if resource.get('uri'):
+            url = '%s/web/index.html#!/server/%s' % (resource['uri'].rstrip('/'), resource['clientIdentifier'])
+        else:
+            url = 'https://app.plex.tv/desktop#!/server/%s?key=' % (resource['clientIdentifier'])
         return click.launch(url)
 
-    def server(self, name=None):
+    def server(self, name=None, scores=False):
         """Command for PlexServer.
 
            Args:
                 name(str): Default None. We will use this one,
                            if not we will check in the config then propt your for one
+                scores(bool): Probe the connections of the server and show their
+                              latency and health instead.
 
            Returns:
                 PlexServer
@@ -90,16 +277,64 @@ class CLI():
         """
 
         n = name or self._servername
+        if scores:
+            resource = self._resource(n) if n else choose('Select server', self._resources(),
+                                                          lambda s: s['name'])[0]
+            self._race(resource, grace=None)
+            for c in rank_connections(resource['connections'], self._prefer):
+                latency = '%.0f ms' % (c['latency'] * 1000) if c.get('latency') is not None else '-'
+                click.echo('%-7s %-10s health %-6s %s' % (location(c), latency, c.get('health', '-'), c['uri']))
+            return
+
         if not n:
             return self._get_server()
 
-        return self.__account.resource(n).connect()
+        return self._connect(self._resource(n))
 
     def account(self):
         """Access to the account."""
-        return self.__account
+        return self._get_account()
 
-    def search(self, query, cmd=None, save_path=None, all_servers=False):
+    def daemon(self, socket=None):
+        """Keep running and take commands from plex-cli-client on a unix socket.
+           The account, the http session and the servers are kept between the
+           commands so they answer a lot faster. The daemon cant ask questions,
+           use --dry_run or --plan_out and apply for the commands that do.
+
+           Args:
+                socket (str): Where to listen, default daemon.sock in the cache dir.
+
+           Example:
+                plex-cli daemon &
+                plex-cli-client kick bob
+        """
+        from .daemon import serve
+        click.echo('Listening on %s' % (socket or socket_path()))
+        serve(socket)
+
+    def _index(self, pms, full=False):
+        """The local library index of a server, refreshed with what changed."""
+        idx = Index(pms)
+        idx.refresh(full=full, page_size=self._page_size)
+        return idx
+
+    def index(self, servername=None, full=False):
+        """Build or refresh the local library index of a server.
+           Commands that takes --use_index reads from this instead of crawling the server.
+
+           Args:
+                servername (str): the server you want to index.
+                full (bool): Crawl everything, not just what has changed. Marking a item as
+                             unwatched doesnt change any date we can ask for, use this to
+                             see those.
+
+        """
+        pms = self._get_server(servername)
+        idx = self._index(pms, full=full)
+        click.echo('%s has %s items in the index' % (pms.friendlyName, idx.count()))
+
+    def search(self, query, cmd=None, save_path=None, all_servers=False, timeout=10, workers=8,
+               connections=4, downloads=2, limit=None, use_index=False):
         """Search plex using hub search on your own or on all servers.
            If you pass a cmd it will be called in the items you select
 
@@ -108,6 +343,12 @@ class CLI():
                 cmd(str): What command to execute, default None.
                 save_path(str): default None, Where to save downloads.
                 all_servers(bool): Should we search all the servers you have access to.
+                timeout(int): Seconds each server gets to answer when using all_servers.
+                workers(int): How many servers we search at the same time.
+                connections(int): How many connections each download use.
+                downloads(int): How many files we download at the same time.
+                limit(str): Max bandwidth for all the downloads, like 10MB (per sec).
+                use_index(bool): Search the titles in the local index of your server.
 
            Returns
                 list: of selected items.
@@ -115,8 +356,23 @@ class CLI():
 
         result = []
         if all_servers:
-            for server in [s for s in self.__account.resources() if 'server' in s.provides]:
-                result += server.connect().search(query)
+            servers = self._resources()
+
+            def hub_search(resource):
+                return self._connect(resource, timeout=timeout).search(query)
+
+            # Search every server at the same time so a slow or offline
+            # server dont block the rest.
+            for resource, items, error in fan_out(hub_search, servers, workers=workers, timeout=timeout):
+                if error is not None:
+                    click.secho('Skipping %s: %s' % (resource['name'], error), fg='red', err=True)
+                    continue
+
+                click.echo('Found %s items on %s' % (len(items), resource['name']), err=True)
+                result += items
+        elif use_index:
+            pms = self._get_server()
+            result += fetch_metadata(pms, [r.ratingKey for r in self._index(pms).records(query=query)])
         else:
             pms = self._get_server()
             result += pms.search(query)
@@ -126,7 +382,8 @@ class CLI():
             if cmd == 'download':
                 if not self._dry_run:
                     result = select(result)
-                    _download(result, save_path)
+                    _download(result, save_path, connections=connections, workers=downloads,
+                              limit=limit)
                 else:
                     click.echo('Skipping download bacause of dry_run')
 
@@ -148,17 +405,68 @@ class CLI():
 
         return result
 
-    def kick(self, user, reason=''):
-        """Stop a playback on your server."""
-        pms = self._get_server()
-        for mediaitem in pms.sessions():
-            un = ''.join(mediaitem.usernames).lower()
+    def _sessions(self, all_servers=False, timeout=10, workers=8):
+        """Session infos from your server, or from all your owned servers at the same time."""
+        if not all_servers:
+            pms = self._get_server()
+            return [dict(session_info(s), server=pms.friendlyName) for s in pms.sessions()]
+
+        def sessions(resource):
+            return self._connect(resource, timeout=timeout).sessions()
+
+        result = []
+        servers = [s for s in self._resources() if s['owned']]
+        for resource, items, error in fan_out(sessions, servers, workers=workers, timeout=timeout):
+            if error is not None:
+                click.secho('Skipping %s: %s' % (resource['name'], error), fg='red', err=True)
+                continue
+            result += [dict(session_info(s), server=resource['name']) for s in items]
+
+        return result
+
+    def kick(self, user, reason='', all_servers=False, timeout=10, workers=8):
+        """Stop a playback on your server.
+
+           Args:
+                user (str): the user you want to kick.
+                reason (str): The reason the user sees.
+                all_servers (bool): Kick the user from all your owned servers.
+                timeout (int): Seconds each server gets to answer when using all_servers.
+                workers (int): How many servers we ask at the same time.
+
+        """
+        for info in self._sessions(all_servers, timeout, workers):
+            un = info['user'].lower()
             if un == user.lower():
-                click.echo('Stopped playback on %s %s' % (un, reason))
-                mediaitem.stop(reason)
+                if self._dry_run:
+                    click.echo('Didnt stop playback on %s %s because of dry_run' % (un, info['server']))
+                    continue
+                click.echo('Stopped playback on %s %s %s' % (un, info['server'], reason))
+                info['item'].stop(reason)
+
+    def watching(self, all_servers=False, timeout=10, workers=8):
+        """Who's streaming from your server.
+
+           Args:
+                all_servers (bool): Show the streams on all your owned servers.
+                timeout (int): Seconds each server gets to answer when using all_servers.
+                workers (int): How many servers we ask at the same time.
+
+        """
+        if all_servers:
+            infos = self._sessions(True, timeout, workers)
+            for info in infos:
+                click.echo('%-15s %-15s %-40s %-6s %-9s %s' % (
+                           info['server'], info['user'], info['title'],
+                           'local' if info['local'] else 'remote',
+                           'transcode' if info['transcode'] else 'direct',
+                           '%.1f Mbps' % (info['bandwidth'] / 1000.0)))
+
+            totals = session_totals(infos)
+            click.echo('%s streams, %s transcoding, %.1f Mbps' % (totals['sessions'], totals['transcodes'],
+                                                                  totals['bandwidth'] / 1000.0))
+            return
 
-    def watching(self):
-        """Who's streaming from your server."""
         pms = self._get_server()
         sessions = pms.sessions()
         c = choose('Select a user',
@@ -167,6 +475,52 @@ class CLI():
 
         return sessions
 
+    def monitor(self, servername=None, rules=None, reason='', baseurl=None, token=None):
+        """Follow what's playing on your server and kick the sessions that matches a rule.
+           Runs until ctrl+c, needs websocket-client.
+
+           Args:
+                servername (str): the server you want to monitor.
+                rules (str): Kick rules separated by ;, every word of a rule has to match.
+                             remote, local, transcode, direct, 4k, 1080, user=name
+                reason (str): The reason the user sees when kicked.
+                baseurl (str): Connect to this url instead, like a local test server.
+                token (str): The token for baseurl.
+
+           Example:
+                plex-cli monitor --rules "remote transcode 4k;user=bob"
+
+        """
+        from plexapi.exceptions import PlexApiException
+        from plexapi.server import PlexServer
+        from requests.exceptions import RequestException
+
+        rules = parse_rules(rules)
+        if baseurl:
+            pms = PlexServer(baseurl, token, session=self._http())
+        else:
+            pms = self._get_server(servername)
+
+        def kick(info, rule):
+            if self._dry_run:
+                click.echo('Didnt kick %s because of dry_run' % info['user'])
+                return
+            try:
+                info['item'].stop(reason)
+                click.secho('Kicked %s playing %s (%s)' % (info['user'], info['title'], rule), fg='red')
+            except (RequestException, PlexApiException) as e:
+                click.secho('Failed to kick %s %s' % (info['user'], e), fg='red')
+
+        def on_change(event, info):
+            click.echo('%-6s %s %s on %s %s' % (event, info['user'], info['title'], info['player'],
+                                                info['state'] or ''))
+
+        table = SessionTable(pms, rules, kick=kick, on_change=on_change)
+        try:
+            listen(pms, table)
+        except KeyboardInterrupt:
+            pass
+
     def share(self, user, sections=None, servername=None):
         """Share library(s) with a user.
            WARNING: BY default this will add EVERY sections!
@@ -188,19 +542,155 @@ class CLI():
             sections = [s for s in pms.section if s.title in sections]
 
         if self._dry_run is False:
-            self.__account.inviteFriend(user, pms, sections)
+            self._get_account().inviteFriend(user, pms, sections)
             click.echo('Shared %s on %s with %s' % (','.join(i.title for i in pms.sections()), pms.friendlyName, user))
 
     def unshare(self, user):
-        self.__account.removeFriend(user)
+        self._get_account().removeFriend(user)
         click.echo('Unshared %s' % user)
 
-    def remove_dupes(self, lang='nor', ignore_category='Family'):
+    def _media_parts(self, item):
+        """(media, part) of a item."""
+        # Remove this hack when https://github.com/pkkid/python-plexapi/issues/201 has been fixed
+        patched_items = []
+        for zomg in item.media:
+            zomg._initpath = item.key
+            patched_items.append(zomg)
+
+        return list(zip(patched_items, item.iterParts()))
+
+    def _fingerprint_dupes(self, pms, use_index=False, path_map=None, exclude=()):
+        """(item, media, part) of the copies found by hashing the files, the oldest copy is kept."""
+        if use_index:
+            recs = self._index(pms).records(('movie', 'show'))
+        else:
+            recs = []
+            for section in pms.library.sections():
+                if section.TYPE in ('movie', 'show'):
+                    recs += iter_records(pms, section_key(section), self._page_size)
+
+        entries = [((r.ratingKey, media), file, size) for r in recs for media, file, size in r.parts]
+        parts = {}
+        for key, _, _ in entries:
+            parts[key] = parts.get(key, 0) + 1
+
+        skip = set((item.ratingKey, media.id) for item, media, _ in exclude)
+        copied = {}
+        for group in dedupe.find_duplicates(entries, dedupe.parse_path_map(path_map)):
+            # The copies that are deleted already as plex duplicates cant be the one we keep.
+            keepable = [c for c in group if not any(key in skip for key, _, _ in c)]
+            if not keepable:
+                continue
+
+            # A file that more then one item points at cant be deleted without
+            # breaking the others, so keep that one. Then the lowest ratingKey,
+            # that's the one that was added first.
+            keep = min(keepable, key=lambda c: (len(c) == 1, min(key for key, _, _ in c)))
+            for copy in group:
+                if copy is not keep and len(copy) == 1 and copy[0][0] not in skip:
+                    copied[copy[0][0]] = copied.get(copy[0][0], 0) + 1
+
+        # Deleting a media deletes all of its parts, so every part needs a copy.
+        found = [key for key, n in copied.items() if n == parts[key]]
+
+        items = dict((int(i.ratingKey), i) for i in fetch_metadata(pms, set(k for k, _ in found)))
+        result = []
+        for key, media_id in found:
+            item = items.get(key)
+            for media, part in self._media_parts(item) if item else []:
+                if media.id == media_id:
+                    result.append((item, media, part))
+
+        click.echo('Found %s duplicates by fingerprint' % len(result))
+        return result
+
+    def _pick_free(self, candidates, free, priority):
+        """Pick the candidates that frees up free and tell the user about it."""
+        if priority not in PRIORITIES:
+            raise ValueError('priority has to be one of %s' % ', '.join(sorted(PRIORITIES)))
+
+        target = parse_size(free)
+        picked, freed = pick_free(candidates, target, priority)
+        if freed < target:
+            click.secho('Can only free up %s of %s' % (convert_size(freed), convert_size(target)), fg='yellow')
+        click.echo('Picked %s of %s candidates, freeing up %s' % (len(picked), len(candidates),
+                                                               convert_size(freed)))
+        return picked
+
+    def _write_plan(self, path, pms, ops):
+        count = write_plan(path, pms, ops)
+        click.echo('Wrote %s operations freeing up %s on %s to %s' % (
+                   count, convert_size(sum(o['size'] or 0 for o in ops)), pms.friendlyName, path))
+        click.echo('Review it and run: plex-cli apply %s' % path)
+
+    def apply(self, path, workers=4):
+        """Apply a plan written by --plan_out.
+
+           What has been done is kept in path.done so you can
+           run it again if it crashed or was stopped.
+
+           Args:
+                path (str): The plan.
+                workers (int): Max operations we run at the same time.
+
+        """
+        from tqdm import tqdm
+
+        header, ops = read_plan(path)
+        done = read_done(path)
+        todo = [o for i, o in enumerate(ops) if i not in done]
+        if not todo:
+            click.echo('Nothing left to do in %s' % path)
+            return
+
+        pms = self._connect(self._resource(header['server']))
+        size = convert_size(sum(o['size'] or 0 for o in todo))
+        click.echo('%s of %s operations left on %s, freeing up %s' % (len(todo), len(ops),
+                                                                      pms.friendlyName, size))
+        if self._dry_run:
+            for o in todo:
+                click.echo('Didnt %s %s because of dry_run' % (o['action'], o['file'] or o['ratingKey']))
+            return
+
+        if not click.confirm('Are your REALLY sure? There is NO turning back..'):
+            return
+
+        skipped = []
+        with tqdm(total=len(todo)) as progress:
+            def done_op(o, applied):
+                progress.update(1)
+                if applied is False:
+                    skipped.append(o)
+
+            executor = AdaptiveExecutor(max_workers=workers)
+            failed = apply_plan(pms, path, executor=executor, callback=done_op)
+
+        click.echo(executor.report())
+        for o in skipped:
+            click.echo('Skipped %s, it is not watched anymore' % (o['file'] or o['ratingKey']))
+        for o, error in failed:
+            click.secho('Failed to %s %s: %s' % (o['action'], o['file'] or o['ratingKey'], error), fg='red')
+        if failed:
+            click.echo('Done. %s operations failed, run apply again to retry them' % len(failed))
+        else:
+            click.echo('Done.')
+
+    def remove_dupes(self, lang='nor', ignore_category='Family', use_index=False, plan_out=None, free=None,
+                     priority='size', fingerprint=False, path_map=None):
         """Remove any duplicates from your movie library.
 
            Args:
                 lang (str): ex nor, eng etc.
                 ingnore_ignore_category (str): Usefull for kids movies where i have duplicates because of language
+                use_index (bool): Find the duplicates in the local index.
+                plan_out (str): Write what would be deleted to this file instead of
+                                asking, use apply to delete it.
+                free (str): Pick what to delete to free up this much, like 2TB.
+                priority (str): What goes first with free: size, oldest (watched) or rating (lowest).
+                fingerprint (bool): Also find duplicates by hashing the files, this finds
+                                    copies plex has matched to different items.
+                path_map (str): Where the files of the server are mounted here when using
+                                fingerprint, like /data=/mnt/nas,/tv=/mnt/tv
 
            Returns:
                 None
@@ -211,44 +701,68 @@ class CLI():
         ignore_category = ignore_category.split()
         removed_files_size = 0
         to_delete = []
-        all_dupes = []
-
-        for section in pms.library.sections():
-            if section.TYPE in ('movie'):
-                all_dupes = section.search(duplicate=True)
-            elif section.TYPE in ('show'):
-                all_dupes += section.search(libtype='episode', duplicate=True)
+        candidates = []
+        dupes = []
 
+        if use_index:
+            dupes += self._index(pms).records(duplicates=True)
+        else:
+            for section in pms.library.sections():
+                if section.TYPE == 'movie':
+                    dupes += section.search(duplicate=True)
+                elif section.TYPE == 'show':
+                    dupes += section.search(libtype='episode', duplicate=True)
+
+        # The listing has no streams, fetch the full metadata in batches
+        # instead of a reload for every item. Same for the genres of the shows.
+        all_dupes = fetch_metadata(pms, [i.ratingKey for i in dupes])
+
+        # (item, media, part) that could go.
+        copies = []
         for item in all_dupes:
-            # Remove this hack when https://github.com/pkkid/python-plexapi/issues/201 has been fixed
-            patched_items = []
-            for zomg in item.media:
-                zomg._initpath = item.key
-                patched_items.append(zomg)
+            parts = sorted(self._media_parts(item), key=lambda i: i[1].size, reverse=True)
+            LOG.debug('Keeping %s %s' %  (parts[0][1].file, convert_size(parts[0][1].size)))
+            copies += [(item, media, part) for media, part in parts[1:]]
 
-            zipped = zip(patched_items, item.iterParts())
-            parts = sorted(zipped, key=lambda i: i[1].size, reverse=True)
+        if fingerprint:
+            copies += self._fingerprint_dupes(pms, use_index, path_map, exclude=copies)
 
-            LOG.debug('Keeping %s %s' %  (parts[0][1].file, convert_size(parts[0][1].size)))
-            for media, part in parts[1:]:
-                LOG.debug('Checking if %s  %s should be deleted' % (part.file, convert_size(part.size)))
+        genres = {}
+        if ignore_category:
+            shows = set(i.grandparentRatingKey for i, _, _ in copies if i.TYPE == 'episode')
+            genres = dict((s.ratingKey, s.genres) for s in fetch_metadata(pms, shows))
 
-                if lang and any([True for i in part.audioStreams() if i.langCode == lang]):
-                    LOG.debug('Skipping, because of lang code')
-                    continue
+        for item, media, part in copies:
+            LOG.debug('Checking if %s  %s should be deleted' % (part.file, convert_size(part.size)))
 
-                elif ignore_category and any(True for i in get_genre(item) if i.tag == ignore_category):
-                    LOG.debug('Skipping, because of ignore_category')
-                    continue
+            if lang and any([True for i in part.audioStreams() if getattr(i, 'languageCode', None) == lang]):
+                LOG.debug('Skipping, because of lang code')
+                continue
 
-                else:
-                    LOG.debug('Added to delete list.')
-                    to_delete.append((media, part))
+            elif ignore_category and any(True for i in get_genre(item, genres) if i.tag in ignore_category):
+                LOG.debug('Skipping, because of ignore_category')
+                continue
+
+            else:
+                LOG.debug('Added to delete list.')
+                to_delete.append((media, part))
+                candidates.append({'size': part.size, 'lastViewedAt': timestamp(item.lastViewedAt),
+                                   'rating': item.rating,
+                                   'op': op(DELETE_MEDIA, item.ratingKey, media.id, part.file, part.size),
+                                   'item': (media, part)})
+
+        if free:
+            candidates = self._pick_free(candidates, free, priority)
+            to_delete = [c['item'] for c in candidates]
+
+        if plan_out:
+            return self._write_plan(plan_out, pms, [c['op'] for c in candidates])
 
         for i, (media, part) in enumerate(to_delete):
-            click.echo('%s: %s' % (i, part.file))
+            click.echo('%s: %s %s' % (i, part.file, convert_size(part.size)))
 
-        result = prompt('Select what files you want to delete', to_delete)
+        # The free target already picked the files.
+        result = to_delete if free else prompt('Select what files you want to delete', to_delete)
 
         delete = False
         if click.confirm('Are your sure you wish to delete %s files' % len(result)):
@@ -260,164 +774,343 @@ class CLI():
             if click.confirm('Are your really sure you want to delete the files? There is NO turning back'):
                 delete = True
 
-        for media, part in result:
-            removed_files_size += part.size
-            if delete:
-                if self._dry_run is False:
-                    click.secho('Deleting %s %s' % (part.file, convert_size(part.size)), fg='red')
-                    media.delete()
-                else:
-                    click.echo('Didnt deleting %s %s because of dry_run' % (part.file, convert_size(part.size)))
+        if delete and self._dry_run is False:
+            executor = AdaptiveExecutor(max_workers=self._max_workers, missing_ok=True)
+            for (media, part), _, error in executor.map(lambda mp: mp[0].delete(), result):
+                if error is not None:
+                    click.secho('Failed to delete %s %s' % (part.file, error), fg='red')
+                    continue
 
+                click.secho('Deleted %s %s' % (part.file, convert_size(part.size)), fg='red')
+                removed_files_size += part.size
+            click.echo(executor.report())
+        else:
+            for media, part in result:
+                removed_files_size += part.size
+                if delete:
+                    click.echo('Didnt deleting %s %s because of dry_run' % (part.file, convert_size(part.size)))
 
         click.secho('Deleted %s files freeing up %s' % (len(result),
                    convert_size(removed_files_size)), fg='red')
 
 
-    def delete_watched(self, server=None, section_type=None, filter=0):
-        """Delete watched content. """
+    def delete_watched(self, server=None, section_type=None, filter=0, use_index=False, plan_out=None,
+                       free=None, priority='oldest'):
+        """Delete watched content.
+
+           Args:
+                server (str): the server you want to delete from.
+                section_type (str): The sections types, default show,movie
+                use_index (bool): Find the watched items in the local index. Items that
+                                  has been marked as unwatched since the last index --full
+                                  are still listed, but they are skipped when we delete.
+                plan_out (str): Write what would be deleted to this file instead of
+                                asking, use apply to delete it. apply skips the items
+                                that are not watched anymore too.
+                free (str): Only delete enough to free up this much, like 2TB.
+                priority (str): What goes first with free: oldest (watched), size or rating (lowest).
+
+        """
 
         server = self._get_server(server)
 
-        if section_type is None:
-            # Lets try to set some sane defaults
-            section_type = ('show', 'movie')
-        else:
-            section_type.split(',')
+        # Lets try to set some sane defaults
+        section_type = parse_list(section_type) or ('show', 'movie')
 
+        # Records are cheap enough to keep all of them around while we ask.
         watched = []
-        for section in server.library.sections():
-            if section.TYPE in section_type:
-                if section.TYPE == 'show':
-                    key = '/library/sections/%s/all?type=4&viewCount>=0' % section.key
-                    watched += section.fetchItems(key)
-
-            elif section.TYPE == 'movie':
-                key = '/library/sections/%s/all?viewCount>=0' % section.key
-                watched += section.fetchItems(key)
+        if use_index:
+            idx = self._index(server)
+            watched += idx.records(section_type, watched=True)
+        else:
+            for section in server.library.sections():
+                if section.TYPE in section_type:
+                    watched += iter_records(server, section_key(section, watched=True), self._page_size)
 
         # TODO
         if filter:
             pass
 
+        if free:
+            candidates = [{'size': r.size, 'lastViewedAt': r.lastViewedAt, 'rating': r.rating, 'item': r}
+                          for r in watched]
+            watched = [c['item'] for c in self._pick_free(candidates, free, priority)]
+
+        if plan_out:
+            # The index or the plan can be old when it's applied, apply
+            # checks that the item is still watched.
+            ops = [op(DELETE_WATCHED, r.ratingKey, file=r.file, size=r.size) for r in watched]
+            return self._write_plan(plan_out, server, ops)
+
         sure = False
         sure = click.confirm('Are your sure your want to delete %s wached items:' % len(watched))
         if sure is True:
             if click.confirm('Are your REALLY sure? There is NO turning back..'):
-                for item in watched:
-                    click.echo('Deleting %s' % item._prettyfilename())
+                if self._dry_run:
+                    for record in watched:
+                        click.echo('Didnt delete %s because of dry_run' % record._prettyfilename())
+                    return
+
+                def delete(record):
+                    item = record.item(server)
+                    # The index cant see that a item was marked as unwatched,
+                    # so check the live item before we delete it.
+                    if not item.viewCount:
+                        return False
                     item.delete()
+                    return True
 
-                click.echo('Done. Deleted %s media items' % len(watched))
-
+                deleted = 0
+                executor = AdaptiveExecutor(max_workers=self._max_workers, missing_ok=True)
+                for record, done, error in executor.map(delete, watched):
+                    if error is not None:
+                        click.secho('Failed to delete %s %s' % (record._prettyfilename(), error), fg='red')
+                        continue
 
+                    # None is a retry that found it already deleted.
+                    if done is False:
+                        click.echo('Skipped %s, it is not watched anymore' % record._prettyfilename())
+                        continue
 
+                    deleted += 1
+                    click.echo('Deleted %s' % record._prettyfilename())
+                    if use_index:
+                        idx.discard(record.ratingKey)
 
+                click.echo(executor.report())
+                click.echo('Done. Deleted %s media items' % deleted)
 
+    def diff(self, my_servername, your_servername, section_type=None, use_index=False, only=None,
+             format='table'):
+        """E-PEEN check, and what you have that they dont and the other way around.
 
-    def diff(self, my_servername, your_servername, section_type=None):
-        """E-PEEN check"""
-        my_result = []
-        your_result = []
+           Args:
+                my_servername (str): your server.
+                your_servername (str): the server you want to compare with.
+                section_type (str): The sections types, default show,movie
+                use_index (bool): Read both libraries from the local index.
+                only (str): Only show mine, yours or both.
+                format (str): table, csv or json (one json object per line).
 
+        """
         mine = self._get_server(my_servername)
         your = self._get_server(your_servername)
-        if section_type is None:
-            # Lets try to set some sane defaults
-            section_type = ('show', 'movie')
-
-        for section in mine.library.sections():
-            if section.TYPE in section_type:
-                my_result += section.all()
-
-        for section in your.library.sections():
-            if section.TYPE in section_type:
-                your_result += section.all()
+        # Lets try to set some sane defaults
+        section_type = parse_list(section_type) or ('show', 'movie')
+
+        def crawl(pms):
+            if use_index:
+                return list(self._index(pms).records(section_type))
+
+            result = []
+            for section in pms.library.sections():
+                if section.TYPE in section_type:
+                    result += iter_records(pms, section_key(section), self._page_size)
+            return result
+
+        # Crawl both at the same time so we only wait for the slowest.
+        results = {}
+        for pms, result, error in fan_out(crawl, [mine, your], workers=2):
+            if error is not None:
+                raise error
+            results[id(pms)] = result
+
+        my_result, your_result = results[id(mine)], results[id(your)]
+
+        if format == 'csv':
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['where', 'type', 'title', 'guid'])
+        totals = {'mine': 0, 'yours': 0, 'both': 0}
+
+        for where, item in compare(my_result, your_result):
+            totals[where] += 1
+            if only and where != only:
+                continue
+
+            if format == 'csv':
+                writer.writerow([where, item.type, item._prettyfilename(), item.guid])
+            elif format == 'json':
+                click.echo(json.dumps({'where': where, 'type': item.type, 'title': item._prettyfilename(),
+                                       'year': item.year, 'guid': item.guid, 'ratingKey': item.ratingKey}))
+            else:
+                click.echo('%-6s %-8s %s' % (where, item.type, item._prettyfilename()))
 
         # Everything below is just silly.
-        click.echo('%s got %s' % (mine.friendlyName, len(my_result)))
-        click.echo('%s got %s' % (your.friendlyName, len(your_result)))
+        click.echo('%s got %s, %s only on %s' % (mine.friendlyName, len(my_result), totals['mine'],
+                                                 mine.friendlyName), err=True)
+        click.echo('%s got %s, %s only on %s' % (your.friendlyName, len(your_result), totals['yours'],
+                                                 your.friendlyName), err=True)
 
         if len(my_result) > len(your_result):
-            click.echo('You won the epeen contest')
+            click.echo('You won the epeen contest', err=True)
         else:
-            click.echo("You lost :'(")
+            click.echo("You lost :'(", err=True)
+
+    def _watched_since(self, pms, section_type, since, use_index=False):
+        """Watched records on pms viewed after since(section)."""
+        result = []
+        if use_index:
+            for record in self._index(pms).records(section_type, watched=True):
+                if (record.lastViewedAt or 0) > (since(record.section) or 0):
+                    result.append(record)
+            return result
+
+        for section in pms.library.sections():
+            if section.TYPE in section_type:
+                mark = since(int(section.key))
+                # >>= is greater than, go back a sec so we dont miss anything.
+                key = section_key(section, watched=True, since=mark - 1 if mark else None)
+                # Let's lean on pms for this one as plexapi does not support this atm
+                # using plexapi for this takes more 40 sec in my library.
+                for record in iter_records(pms, key, self._page_size):
+                    record.section = int(section.key)
+                    result.append(record)
+        return result
+
+    def _guid_index(self, pms, section_type, use_index=False):
+        """Every item on pms by guid.
+
+           Fetch every section once and match on guid locally, asking the server
+           for each item takes hours on a large library. We only need guid and
+           viewCount so use records, the plexapi object is only fetched for the
+           items we have to mark as watched.
+        """
+        if use_index:
+            return guid_index(self._index(pms).records(section_type))
 
-        #missing = []
-        #for your_item in your_result:
-        #    if your_item not in my_result:
-        #        missing.append(your_item)
+        index = {}
+        for section in pms.library.sections():
+            if section.TYPE in section_type:
+                index.update(guid_index(iter_records(pms, section_key(section), self._page_size)))
+        return index
+
+    def _push_watched(self, source, target, records, index, position=0):
+        """Mark records from source as watched on target and move the marks."""
+        from tqdm import tqdm
+
+        marks = {}
+        todo = {}
+        for item in records:
+            marks[item.section] = max(marks.get(item.section) or 0, item.lastViewedAt or 0)
+            mf = index.get(item.guid)
+            # Not on the target or it's already watched.
+            if mf is not None and not mf.viewCount:
+                todo[mf.ratingKey] = mf
+
+        if self._dry_run:
+            for mf in todo.values():
+                tqdm.write('Skipping %s on %s because of dry_run' % (mf._prettyfilename(), target.friendlyName))
+            return
+
+        executor = AdaptiveExecutor(max_workers=self._max_workers)
+        with tqdm(total=len(todo), desc=target.friendlyName, position=position) as progress:
+            for mf, _, error in executor.map(lambda r: r.mark_watched(target), todo.values()):
+                progress.update(1)
+                if error is not None:
+                    tqdm.write('Failed to set %s as WATCHED on %s %s' % (mf._prettyfilename(),
+                                                                         target.friendlyName, error))
+                    continue
 
-        #for miss in missing:
-        #    click.echo(miss.title)
+                tqdm.write('Set %s as WATCHED on %s' % (mf._prettyfilename(), target.friendlyName))
+                mf.viewCount = 1
 
-    def sync(self, frm=None, too=None, section_type=None, two_way=False):
+        tqdm.write('%s: %s' % (target.friendlyName, executor.report()))
+        # Only move the marks when everything went well.
+        if not executor.failed:
+            cache.set_marks(source.machineIdentifier, target.machineIdentifier, marks)
+
+    def sync(self, frm=None, too=None, section_type=None, two_way=False, use_index=False, full=False):
         """ Sync between servers.
 
+            The source is only scanned once no matter how many servers you sync
+            too, and only what has been watched since the last sync is synced.
+            A server that fails doesn't stop the sync to the others.
+
             Args:
                 frm (str): the server you want to sync from
-                too (str): the server you want to sync too
+                too (str): the server(s) you want to sync too, comma separated.
                 section_type(str): The sections types you want synced.
-                two_way (bool): Sync two ways
+                two_way (bool): Sync two ways, what's watched on the targets is synced back too.
+                use_index (bool): Read the libraries from the local index.
+                full (bool): Ignore what we have synced before.
 
         """
-        my_result = []
-        your_result = []
-
         your = self._get_server(frm, msg='Select the server you want to sync from')
-        mine = self._get_server(too, msg='Select the server you want to sync too')
-
-        if section_type is None:
-            # Lets try to set some sane defaults
-            section_type = ('show', 'movie')
+        # The targets are connected in push and pull, so a server that is
+        # down is reported as failed without holding up the others.
+        if too is None:
+            targets = [self._pick_resource(msg='Select the server you want to sync too')]
         else:
-            section_type.split(',')
-
-        for section in your.library.sections():
-            # Let's lean on pms for this one as plexapi does not support this atm
-            # using plexapi for this takes more 40 sec in my library.
-            if section.TYPE == 'show':
-                key = '/library/sections/%s/all?type=4&viewCount>=0' % section.key
-                your_result += section.fetchItems(key)
-
-            elif section.TYPE == 'movie':
-                key = '/library/sections/%s/all?viewCount>=0' % section.key
-                your_result += section.fetchItems(key)
-
-        # remove this when it cached in plexapi
-        check_sections = [section for section in your.library.sections() if section.TYPE in section_type]
-        with tqdm(your_result) as yr:
-            for item in yr:
-                for section in check_sections:
-                    # Accessing a guid requires a reload..
-                    # But i dont't know a better way to make sure
-                    # we checking the same items.
-                    result = section.search(guid=item.guid)
-                    if result:
-                        mf = result[0]
-                        tqdm.write('Setting %s as WATCHED on %s' % (mf._prettyfilename(), mine.friendlyName))
-                        mf.markAsWatched()
+            targets = [self._resource(name) for name in parse_list(too)]
+
+        # Lets try to set some sane defaults
+        section_type = parse_list(section_type) or ('show', 'movie')
+
+        def marks(source, target):
+            """The marks from source to target, the clientIdentifier of a
+               resource is the machineIdentifier of the server.
+            """
+            def since(section):
+                if full:
+                    return None
+                return cache.get_mark(source, target, section)
+            return since
+
+        servers = {}
+
+        def connect(resource):
+            # Each target is only used by one thread at a time.
+            if resource['clientIdentifier'] not in servers:
+                servers[resource['clientIdentifier']] = self._connect(resource)
+            return servers[resource['clientIdentifier']]
+
+        # Scan the source once from the oldest mark of all the targets.
+        def oldest(section):
+            return min(marks(your.machineIdentifier, t['clientIdentifier'])(section) or 0 for t in targets)
+
+        your_result = self._watched_since(your, section_type, oldest, use_index)
+        if not your_result:
+            click.echo('Nothing new has been watched on %s' % your.friendlyName)
+
+        def push(args):
+            position, resource = args
+            since = marks(your.machineIdentifier, resource['clientIdentifier'])
+            records = [r for r in your_result if (r.lastViewedAt or 0) > (since(r.section) or 0)]
+            if not records:
+                return
+            target = connect(resource)
+            self._push_watched(your, target, records, self._guid_index(target, section_type, use_index),
+                               position=position)
+
+        for (_, resource), _, error in fan_out(push, list(enumerate(targets)), workers=len(targets)):
+            if error is not None:
+                click.secho('Failed to sync to %s: %s' % (resource['name'], error), fg='red', err=True)
 
         if two_way:
             click.echo('Started too sync the other way')
-            sync(mine.friendlyName, your.friendlyName, section_type=','.join(section_type))
-
-
-
-
-
-
-
-
-
-
-
+            # Every target is synced into the source, so we only need one index of it.
+            index = self._guid_index(your, section_type, use_index)
 
+            def pull(args):
+                position, resource = args
+                target = connect(resource)
+                records = self._watched_since(target, section_type,
+                                              marks(target.machineIdentifier, your.machineIdentifier), use_index)
+                self._push_watched(target, your, records, index, position=position)
 
+            for (_, resource), _, error in fan_out(pull, list(enumerate(targets)), workers=len(targets)):
+                if error is not None:
+                    click.secho('Failed to sync from %s: %s' % (resource['name'], error), fg='red', err=True)
 
 
 
 def main():
+    import fire
+    if not set(sys.argv[1:]) & {'-i', '--interactive'}:
+        # fire asks IPython for the docstrings in the help if it's installed,
+        # that import alone takes longer than the rest of the startup. It falls
+        # back to inspect when the import fails.
+        sys.modules.setdefault('IPython', None)
     fire.Fire(CLI)
 
 
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Thin client for the daemon, use it like plex-cli.
+
+This only imports what it needs to talk to the socket so it starts fast.
+If no daemon is running the command is run the normal way.
+"""
+
+import json
+import os
+import socket
+import sys
+
+from . import cache
+
+
+def socket_path():
+    return os.environ.get('PLEXCLI_SOCKET') or os.path.join(cache.CACHE_DIR, 'daemon.sock')
+
+
+def call(argv, path=None, out=None, err=None):
+    """Run argv in the daemon, returns the exit code or None if there is no daemon."""
+    out = out or sys.stdout
+    err = err or sys.stderr
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        sock.sendall((json.dumps({'argv': list(argv), 'cwd': os.getcwd()}) + '\n').encode('utf-8'))
+        f = sock.makefile('rb')
+        for line in f:
+            msg = json.loads(line.decode('utf-8'))
+            if 'exit' in msg:
+                return msg['exit']
+            if 'out' in msg:
+                out.write(msg['out'])
+                out.flush()
+            if 'err' in msg:
+                err.write(msg['err'])
+                err.flush()
+    finally:
+        sock.close()
+
+    err.write('The daemon went away\n')
+    return 1
+
+
+def main():
+    argv = sys.argv[1:]
+    code = call(argv) if hasattr(socket, 'AF_UNIX') else None
+    if code is None:
+        from .cli import main as cli_main
+        return cli_main()
+    sys.exit(code)
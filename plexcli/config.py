@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""Read the plexapi config without importing plexapi.
+
+Importing plexapi takes about 100 ms as it pulls in requests and sets up
+its session, most of what plexcli does at startup is reading a couple of
+values from the config. This reads the same file and env vars as
+plexapi.CONFIG does.
+"""
+
+import os
+
+try:
+    from configparser import ConfigParser, Error
+except ImportError:
+    from ConfigParser import SafeConfigParser as ConfigParser, Error
+
+
+CONFIG_PATH = os.environ.get('PLEXAPI_CONFIG_PATH', os.path.expanduser('~/.config/plexapi/config.ini'))
+
+_parser = None
+
+
+def get(key, default=None):
+    """Value of key like auth.myplex_username, the env var PLEXAPI_AUTH_MYPLEX_USERNAME wins."""
+    value = os.environ.get('PLEXAPI_%s' % key.upper().replace('.', '_'))
+    if value is not None:
+        return value
+
+    global _parser
+    if _parser is None:
+        _parser = ConfigParser()
+        try:
+            _parser.read(CONFIG_PATH)
+        except Error:
+            pass
+
+    section, name = key.lower().split('.')
+    for s in _parser.sections():
+        if s.lower() == section and _parser.has_option(s, name):
+            return _parser.get(s, name, raw=True)
+    return default
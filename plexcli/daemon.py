@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Keep plexcli running and take commands over a unix socket.
+
+A normal run pays for the python startup, importing plexapi, the sign in
+and connecting to the server before it does anything. The daemon does that
+once and keeps the account, the http session and the servers it has
+connected to around, so a command from the client only costs the requests
+the command itself makes.
+
+The protocol is json lines. The client sends {"argv": [...], "cwd": ...},
+the daemon answers with {"out": text} and {"err": text} as the command
+writes them and ends with {"exit": code}. Commands run one at the time as
+they share stdout, and the daemon cant ask questions so anything that
+prompts is aborted, use --dry_run or --plan_out and apply for those.
+"""
+
+import io
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+import traceback
+
+import click
+import fire
+from plexapi.exceptions import PlexApiException
+from requests.exceptions import RequestException
+
+from .client import socket_path
+
+
+LOG = logging.getLogger(__file__)
+
+
+class _Stream(io.TextIOBase):
+    """Send what's written to the client as it's written."""
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8', 'replace')
+        if s:
+            send(self.conn, {self.kind: s})
+        return len(s)
+
+
+def send(conn, msg):
+    conn.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+
+def run_command(cli, argv, out, err):
+    """Run argv with fire like plex-cli would, returns the exit code."""
+    old = sys.stdout, sys.stderr, sys.stdin
+    sys.stdout, sys.stderr, sys.stdin = out, err, io.StringIO()
+    try:
+        fire.Fire(cli.CLI, command=list(argv), name='plex-cli')
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else int(e.code is not None)
+    except click.exceptions.Abort:
+        err.write('Aborted, the daemon cant ask questions. Use --dry_run or --plan_out and apply.\n')
+        return 1
+    except (RequestException, PlexApiException):
+        # The server might have moved, connect again next time.
+        for key in [k for k in cli.CLI._warm if k[0] == 'server']:
+            del cli.CLI._warm[key]
+        err.write(traceback.format_exc())
+        return 1
+    except Exception:
+        err.write(traceback.format_exc())
+        return 1
+    finally:
+        for report in cli.CLI._warm.pop(('reports',), []):
+            report()
+        sys.stdout, sys.stderr, sys.stdin = old
+
+
+def _handle(cli, conn):
+    f = conn.makefile('rb')
+    try:
+        msg = json.loads(f.readline().decode('utf-8'))
+    finally:
+        f.close()
+
+    cwd = os.getcwd()
+    try:
+        os.chdir(msg.get('cwd') or cwd)
+        code = run_command(cli, msg['argv'], _Stream(conn, 'out'), _Stream(conn, 'err'))
+    finally:
+        os.chdir(cwd)
+    send(conn, {'exit': code})
+
+
+def _listen(path):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # Left behind by a daemon that died.
+            os.remove(path)
+        else:
+            raise RuntimeError('A daemon is already running on %s' % path)
+        finally:
+            probe.close()
+
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent, stat.S_IRWXU)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner can talk to the daemon, it can use your token.
+    old = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old)
+    sock.listen(16)
+    return sock
+
+
+def serve(path=None, stop=None):
+    """Take commands on the unix socket at path until stop() is True or ctrl+c."""
+    if not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError('The daemon needs unix sockets')
+
+    path = path or socket_path()
+    from . import cli
+    cli.CLI._warm = {}
+    sock = _listen(path)
+    sock.settimeout(1)
+    LOG.debug('Listening on %s', path)
+    try:
+        while not (stop and stop()):
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                continue
+
+            conn.settimeout(None)
+            try:
+                _handle(cli, conn)
+            except (socket.error, ValueError, KeyError) as e:
+                LOG.debug('Bad client %s', e)
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.remove(path)
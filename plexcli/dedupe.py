@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Find duplicates by looking at the files themselves.
+
+Plex only flags items with more then one version as duplicates, so a copy
+of a file that is matched to different metadata, or sits in another
+section, is never found. Here we group every part by size, and only the
+parts that share a size are hashed. Parts that point at the same file on
+disk are one copy and never duplicates of each other. We dont hash the whole file, a handful of evenly spaced
+samples is plenty to tell media files apart and is fast on big libraries.
+The files has to be reachable from where plexcli runs, use path_map when
+the server sees them under another path.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+from collections import defaultdict
+
+
+LOG = logging.getLogger(__file__)
+
+SAMPLES = 8
+SAMPLE_SIZE = 64 * 1024
+
+
+def parse_path_map(path_map):
+    """Parse /server/path=/local/path,... into a list of (server, local)."""
+    if not path_map:
+        return []
+    result = []
+    for pair in path_map.split(','):
+        remote, _, local = pair.partition('=')
+        result.append((remote, local))
+    # Longest prefix first.
+    return sorted(result, key=lambda p: len(p[0]), reverse=True)
+
+
+def local_path(file, path_map=None):
+    """The path to a server file on this machine."""
+    for remote, local in path_map or []:
+        if file.startswith(remote):
+            return local + file[len(remote):]
+    return file
+
+
+def group_by_size(entries):
+    """Group (key, file, size) entries by size, only sizes with more then one entry are kept."""
+    groups = defaultdict(list)
+    for entry in entries:
+        if entry[2]:
+            groups[entry[2]].append(entry)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def _offsets(size, samples=SAMPLES, sample_size=SAMPLE_SIZE):
+    if size <= samples * sample_size:
+        return [(0, size)]
+    return [(i * (size - sample_size) // (samples - 1), sample_size) for i in range(samples)]
+
+
+def sample_hash(path, samples=SAMPLES, sample_size=SAMPLE_SIZE):
+    """Hash samples spread out over the file at path, the first and the last included."""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error, OSError):
+            # Empty files and some network filesystems.
+            mm = None
+
+        for start, length in _offsets(size, samples, sample_size):
+            if mm is not None:
+                h.update(mm[start:start + length])
+            else:
+                f.seek(start)
+                h.update(f.read(length))
+
+        if mm is not None:
+            mm.close()
+
+    return h.hexdigest()
+
+
+def _hash(path):
+    try:
+        return sample_hash(path)
+    except (IOError, OSError) as e:
+        LOG.debug('Cant hash %s %s', path, e)
+        return None
+
+
+def _identity(path):
+    """The same file under two paths, or hard linked, gives the same identity."""
+    try:
+        st = os.stat(path)
+    except (IOError, OSError):
+        return path
+    return (st.st_dev, st.st_ino)
+
+
+def find_duplicates(entries, path_map=None, workers=None):
+    """Find the entries that has the same content.
+
+       Entries that point at the same file, like a folder that is added to two
+       sections, are one copy. They are not duplicates of each other, deleting
+       one of them deletes the file for all of them.
+
+       Args:
+            entries (list): of (key, file, size), key can be anything.
+            path_map (list): of (server path, local path), see parse_path_map.
+            workers (int): Processes used for hashing, default one per core, 1 hashes in this process.
+
+       Returns:
+            list: of groups of copies with the same content, a copy is the list
+                  of entries that share one file.
+    """
+    copies = defaultdict(list)
+    paths = {}
+    for entry in (e for g in group_by_size(entries) for e in g):
+        path = local_path(entry[1], path_map)
+        key = _identity(path)
+        copies[key].append(entry)
+        paths[key] = path
+
+    # Only hash each file once, and only the sizes that still has more then one file.
+    todo = [key for g in group_by_size((key, paths[key], c[0][2]) for key, c in copies.items())
+            for key, _, _ in g]
+    missing = sum(1 for key in todo if not os.path.isfile(paths[key]))
+    if missing:
+        LOG.warning('%s of %s files are not reachable from here, use path_map', missing, len(todo))
+
+    if workers == 1:
+        digests = [_hash(paths[key]) for key in todo]
+    else:
+        # multiprocessing is slow to import, only pay for it when we hash.
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            digests = list(pool.map(_hash, [paths[key] for key in todo], chunksize=16))
+
+    groups = defaultdict(list)
+    for key, digest in zip(todo, digests):
+        if digest is not None:
+            groups[digest].append(copies[key])
+    return [g for g in groups.values() if len(g) > 1]
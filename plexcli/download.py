@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""Ranged downloads using several connections at once, with resume."""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from tqdm import tqdm
+
+
+LOG = logging.getLogger(__file__)
+
+CHUNK_SIZE = 16 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+MANIFEST = '.plexcli-downloads.json'
+
+
+class Throttle(object):
+    """Token bucket shared by every connection to cap the total bandwidth."""
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._allowance = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= n
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save_state(path, state):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    if os.path.exists(path) and os.name == 'nt':
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def remote_size(url, session, headers=None):
+    """Returns (size, supports ranges) for url."""
+    h = dict(headers or {}, Range='bytes=0-0')
+    r = session.get(url, headers=h, stream=True, timeout=30)
+    try:
+        r.raise_for_status()
+        if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+            return int(r.headers['Content-Range'].rsplit('/', 1)[1]), True
+        return int(r.headers.get('Content-Length', 0)), False
+    finally:
+        r.close()
+
+
+def chunks(size, chunk_size=CHUNK_SIZE):
+    """Split size in (idx, start, end) byte ranges, end is inclusive."""
+    return [(i, start, min(start + chunk_size, size) - 1)
+            for i, start in enumerate(range(0, size, chunk_size))]
+
+
+def _stream(url, filepath, session, headers=None, written=None):
+    """Plain single connection download for servers that dont do ranges."""
+    r = session.get(url, headers=headers, stream=True, timeout=30)
+    r.raise_for_status()
+    with open(filepath, 'wb') as f:
+        for block in r.iter_content(BLOCK_SIZE):
+            f.write(block)
+            if written is not None:
+                written(len(block))
+
+
+def download(url, filepath, session=None, headers=None, connections=4, chunk_size=CHUNK_SIZE,
+             showstatus=False, progress=None, throttle=None):
+    """Download url to filepath using HTTP Range requests over several connections.
+
+       The data is written into a preallocated filepath.part and the chunks
+       that are done are kept in a filepath.state sidecar, so a download that
+       was interrupted picks up where it stopped. The .part file is renamed
+       to filepath when every chunk is done.
+
+       Args:
+            url (str): What to download.
+            filepath (str): Where to save it.
+            session (requests.Session): Session to use, default a new one.
+            headers (dict): Extra headers, like X-Plex-Token.
+            connections (int): How many chunks we fetch at the same time.
+            chunk_size (int): Size of each ranged request in bytes.
+            showstatus (bool): Show a progress bar.
+            progress (tqdm): Shared progress bar to update instead of our own.
+            throttle (Throttle): Shared bandwidth limit.
+
+       Returns:
+            str: filepath
+    """
+    session = session or requests.Session()
+    partpath = '%s.part' % filepath
+    statepath = '%s.state' % filepath
+
+    size, ranges = remote_size(url, session, headers)
+    own = progress is None
+    if own:
+        progress = tqdm(total=size, unit='B', unit_scale=True, desc=os.path.basename(filepath),
+                        disable=not showstatus)
+
+    def written(n):
+        progress.update(n)
+        if throttle is not None:
+            throttle.consume(n)
+
+    try:
+        if not ranges or size <= chunk_size or connections < 2:
+            _stream(url, partpath, session, headers, written)
+            os.rename(partpath, filepath)
+            return filepath
+
+        state = _load_state(statepath)
+        if (not state or state.get('size') != size or state.get('chunk_size') != chunk_size or
+                not os.path.exists(partpath)):
+            state = {'url': url, 'size': size, 'chunk_size': chunk_size, 'done': []}
+            with open(partpath, 'wb') as f:
+                f.truncate(size)
+            _save_state(statepath, state)
+        else:
+            LOG.debug('Resuming %s, %s chunks done', filepath, len(state['done']))
+
+        done = set(state['done'])
+        todo = [c for c in chunks(size, chunk_size) if c[0] not in done]
+        progress.update(size - sum(end - start + 1 for _, start, end in todo))
+        lock = threading.Lock()
+
+        def fetch(chunk):
+            idx, start, end = chunk
+            h = dict(headers or {}, Range='bytes=%s-%s' % (start, end))
+            r = session.get(url, headers=h, stream=True, timeout=30)
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise IOError('Server ignored the range request for %s' % url)
+
+            with open(partpath, 'r+b') as f:
+                f.seek(start)
+                got = 0
+                for block in r.iter_content(BLOCK_SIZE):
+                    f.write(block)
+                    got += len(block)
+                    written(len(block))
+
+            if got != end - start + 1:
+                raise IOError('Chunk %s of %s was %s bytes, expected %s' %
+                              (idx, url, got, end - start + 1))
+
+            with lock:
+                done.add(idx)
+                state['done'] = sorted(done)
+                _save_state(statepath, state)
+
+        pool = ThreadPoolExecutor(max_workers=connections)
+        try:
+            # Make sure the first error is raised.
+            for _ in pool.map(fetch, todo):
+                pass
+        finally:
+            pool.shutdown(wait=True)
+    finally:
+        if own:
+            progress.close()
+
+    os.rename(partpath, filepath)
+    os.remove(statepath)
+    return filepath
+
+
+class Manifest(object):
+    """The files we have downloaded to a dir and their size."""
+    def __init__(self, path):
+        self.path = os.path.join(path, MANIFEST)
+        self.files = _load_state(self.path) or {}
+        self._lock = threading.Lock()
+
+    def complete(self, filepath, size):
+        """Is filepath already downloaded with the expected size."""
+        name = os.path.basename(filepath)
+        return (self.files.get(name) == size and os.path.exists(filepath) and
+                os.path.getsize(filepath) == size)
+
+    def add(self, filepath, size):
+        with self._lock:
+            self.files[os.path.basename(filepath)] = size
+            _save_state(self.path, self.files)
+
+
+def download_many(jobs, path, workers=2, connections=4, limit=None, showstatus=True):
+    """Download several files at the same time with one progress bar.
+
+       Files in the manifest of path that already have the expected size
+       are skipped, so running the same download again only gets what's missing.
+
+       Args:
+            jobs (list): of dicts with url, filename, size and optional session and headers.
+            path (str): Dir to save the files in.
+            workers (int): How many files we download at the same time.
+            connections (int): How many connections each file use.
+            limit (int): Max bytes per sec for all the downloads together.
+            showstatus (bool): Show a progress bar.
+
+       Returns:
+            list: of filepaths
+    """
+    manifest = Manifest(path)
+    throttle = Throttle(limit) if limit else None
+    locs = []
+    todo = []
+    for job in jobs:
+        filepath = os.path.join(path, job['filename'])
+        if job.get('size') and manifest.complete(filepath, job['size']):
+            LOG.debug('Skipping %s, already downloaded', filepath)
+            locs.append(filepath)
+        else:
+            todo.append((filepath, job))
+
+    progress = tqdm(total=sum(job.get('size') or 0 for _, job in todo), unit='B', unit_scale=True,
+                    desc='%s files' % len(todo), disable=not showstatus)
+
+    def run(task):
+        filepath, job = task
+        download(job['url'], filepath, session=job.get('session'), headers=job.get('headers'),
+                 connections=connections, progress=progress, throttle=throttle)
+        manifest.add(filepath, os.path.getsize(filepath))
+        return filepath
+
+    with progress:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for future in as_completed([pool.submit(run, task) for task in todo]):
+                filepath = future.result()
+                progress.write('Downloaded %s' % os.path.basename(filepath))
+                locs.append(filepath)
+        finally:
+            pool.shutdown(wait=True)
+
+    return locs
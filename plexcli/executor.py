@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Run server mutations with a concurrency that adapts to the server.
+
+Running deletes or markAsWatched one by one is slow, but hammering a small
+NAS with 16 at the time gives you 500s and angry users. We start with a few
+workers and use AIMD: every fast call adds a little to the limit, a slow or
+failed call halves it.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+LOG = logging.getLogger(__file__)
+
+
+class AdaptiveExecutor(object):
+    """Run mutations with AIMD concurrency and retries.
+
+       Args:
+            workers (int): How many we start with.
+            min_workers (int): Never go below this.
+            max_workers (int): Never go above this.
+            target_latency (float): Calls slower than this sec counts as overload.
+            retries (int): How many times a failed call is retried.
+            backoff (float): Sec to wait before the first retry, doubled for each retry.
+            missing_ok (bool): A NotFound on a retry means the call that failed got
+                               through after all, count it as done. Use it for deletes.
+    """
+    def __init__(self, workers=2, min_workers=1, max_workers=8, target_latency=1.0, retries=3, backoff=0.5,
+                 missing_ok=False):
+        self.max_workers = max(max_workers, 1)
+        self.min_workers = min(max(min_workers, 1), self.max_workers)
+        self.limit = float(min(max(workers, self.min_workers), self.max_workers))
+        self.target_latency = target_latency
+        self.retries = retries
+        self.backoff = backoff
+        self.missing_ok = missing_ok
+        self.done = 0
+        self.failed = 0
+        self.elapsed = 0
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+
+    def _release(self, ok, latency):
+        with self._cond:
+            self._active -= 1
+            if ok and latency <= self.target_latency:
+                self.limit = min(self.max_workers, self.limit + 1.0 / self.limit)
+            else:
+                self.limit = max(self.min_workers, self.limit / 2)
+                LOG.debug('Backing off to %s workers', int(self.limit))
+            self._cond.notify_all()
+
+    def _call(self, func, item):
+        from plexapi.exceptions import BadRequest, NotFound, Unauthorized
+
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.time()
+            try:
+                result = func(item)
+            # Retrying these wont help, and they say nothing about the load on the server.
+            # BadRequest is what we get when deleting is turned off on the server.
+            except (BadRequest, NotFound, Unauthorized) as e:
+                self._release(True, 0)
+                if attempt and self.missing_ok and isinstance(e, NotFound):
+                    return None
+                raise
+            except Exception as e:
+                self._release(False, time.time() - start)
+                if attempt >= self.retries:
+                    raise
+                LOG.debug('Retrying %s after %s', item, e)
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+                attempt += 1
+            else:
+                self._release(True, time.time() - start)
+                return result
+
+    def map(self, func, items):
+        """Call func on every item, yields (item, result, error) as they finish."""
+        start = time.time()
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = dict((pool.submit(self._call, func, item), item) for item in items)
+            for future in as_completed(futures):
+                try:
+                    result, error = future.result(), None
+                    self.done += 1
+                except Exception as e:
+                    result, error = None, e
+                    self.failed += 1
+                yield futures[future], result, error
+        finally:
+            pool.shutdown(wait=True)
+            self.elapsed += time.time() - start
+
+    def report(self):
+        rate = self.done / self.elapsed if self.elapsed else 0
+        return 'Did %s operations in %.1f sec (%.1f/sec), %s failed' % (self.done, self.elapsed, rate,
+                                                                         self.failed)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""Local sqlite snapshot of the library of a server.
+
+The first run crawls every movie and show section, later runs only fetch
+the items that has been updated or watched since the last run. Commands
+can then read records from here instead of crawling the server.
+
+Marking a item as unwatched changes neither updatedAt nor lastViewedAt, and
+a delete plus a add between two runs keeps the count the same, so only a
+full refresh sees those. Check the live item before changing anything.
+"""
+
+import logging
+import os
+import sqlite3
+import stat
+
+from . import cache
+from .records import FIELDS, Record, iter_records
+from .utils import PAGE_SIZE, count_items, section_key
+
+
+LOG = logging.getLogger(__file__)
+
+COLUMNS = FIELDS[:-1]
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sections (key INTEGER PRIMARY KEY, type TEXT, title TEXT);
+CREATE TABLE IF NOT EXISTS items (ratingKey INTEGER PRIMARY KEY, guid TEXT, type TEXT, title TEXT,
+    year INTEGER, grandparentTitle TEXT, parentIndex INTEGER, "index" INTEGER, viewCount INTEGER,
+    lastViewedAt INTEGER, addedAt INTEGER, updatedAt INTEGER, rating REAL, section INTEGER);
+CREATE TABLE IF NOT EXISTS parts (ratingKey INTEGER, media INTEGER, file TEXT, size INTEGER);
+CREATE INDEX IF NOT EXISTS items_guid ON items (guid);
+CREATE INDEX IF NOT EXISTS items_section ON items (section, viewCount);
+CREATE INDEX IF NOT EXISTS parts_key ON parts (ratingKey);
+'''
+
+
+class Index(object):
+    """The library of a server in sqlite.
+
+       Args:
+            server (PlexServer): The server to index.
+            path (str): Where to keep the db, default one file per server in the cache dir.
+    """
+    def __init__(self, server, path=None):
+        self.server = server
+        if path is None:
+            if not os.path.isdir(cache.CACHE_DIR):
+                os.makedirs(cache.CACHE_DIR, stat.S_IRWXU)
+            path = os.path.join(cache.CACHE_DIR, 'index-%s.db' % server.machineIdentifier)
+
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        # Indexes made before we stored the rating.
+        if 'rating' not in [row[1] for row in self.db.execute('PRAGMA table_info(items)')]:
+            self.db.execute('ALTER TABLE items ADD COLUMN rating REAL')
+
+    def refresh(self, full=False, page_size=PAGE_SIZE):
+        """Crawl the movie and show sections, only what changed unless full."""
+        keys = []
+        for section in self.server.library.sections():
+            if section.TYPE in ('movie', 'show'):
+                keys.append(int(section.key))
+                self._refresh_section(section, full, page_size)
+
+        # Sections that has been removed from the server.
+        gone = [k for (k,) in self.db.execute('SELECT key FROM sections') if k not in keys]
+        for key in gone:
+            self._clear(key)
+            self.db.execute('DELETE FROM sections WHERE key = ?', (key,))
+
+        self.db.commit()
+
+    def _refresh_section(self, section, full, page_size):
+        key = section_key(section)
+        skey = int(section.key)
+        known = self.db.execute('SELECT 1 FROM sections WHERE key = ?', (skey,)).fetchone()
+
+        if known and not full:
+            marks = self.db.execute('SELECT max(updatedAt), max(lastViewedAt) FROM items WHERE section = ?',
+                                    (skey,)).fetchone()
+            for field, mark in zip(('updatedAt', 'lastViewedAt'), marks):
+                if mark:
+                    # >>= is greater than, go back a sec so we dont miss anything.
+                    changed = '%s%s%s>>=%s' % (key, '&' if '?' in key else '?', field, mark - 1)
+                    self._store(skey, iter_records(self.server, changed, page_size))
+
+            # Deletes can't be found by date, if the numbers dont add up we crawl it all.
+            if count_items(self.server, key) == self.count(sections=[skey]):
+                return
+
+            LOG.debug('%s has changed, crawling it all', section.title)
+
+        self._clear(skey)
+        self.db.execute('INSERT OR REPLACE INTO sections VALUES (?, ?, ?)', (skey, section.TYPE, section.title))
+        self._store(skey, iter_records(self.server, key, page_size))
+
+    def _clear(self, skey):
+        self.db.execute('DELETE FROM parts WHERE ratingKey IN (SELECT ratingKey FROM items WHERE section = ?)',
+                        (skey,))
+        self.db.execute('DELETE FROM items WHERE section = ?', (skey,))
+
+    def _store(self, skey, records):
+        for record in records:
+            record.section = skey
+            self.db.execute('INSERT OR REPLACE INTO items (%s) VALUES (%s)' % (
+                            ', '.join('"%s"' % c for c in COLUMNS), ', '.join('?' * len(COLUMNS))),
+                            [getattr(record, c) for c in COLUMNS])
+            self.db.execute('DELETE FROM parts WHERE ratingKey = ?', (record.ratingKey,))
+            self.db.executemany('INSERT INTO parts VALUES (?, ?, ?, ?)',
+                                [(record.ratingKey,) + part for part in record.parts])
+
+    def discard(self, ratingKey):
+        """Forget a item, use this after it's deleted from the server."""
+        self.db.execute('DELETE FROM parts WHERE ratingKey = ?', (ratingKey,))
+        self.db.execute('DELETE FROM items WHERE ratingKey = ?', (ratingKey,))
+        self.db.commit()
+
+    def _where(self, section_type=None, sections=None):
+        where, params = ['1'], []
+        if section_type is not None:
+            where.append('s.type IN (%s)' % ', '.join('?' * len(section_type)))
+            params += list(section_type)
+        if sections is not None:
+            where.append('i.section IN (%s)' % ', '.join('?' * len(sections)))
+            params += list(sections)
+        return where, params
+
+    def count(self, section_type=None, sections=None):
+        where, params = self._where(section_type, sections)
+        sql = 'SELECT count(*) FROM items i JOIN sections s ON i.section = s.key WHERE %s' % ' AND '.join(where)
+        return self.db.execute(sql, params).fetchone()[0]
+
+    def records(self, section_type=None, watched=None, query=None, duplicates=False):
+        """Yield records from the index.
+
+           Args:
+                section_type (list): Only these section types, like show and movie.
+                watched (bool): Only watched (True) or unwatched (False) items.
+                query (str): Only items where the title (or show title) contains this.
+                duplicates (bool): Only items with more then one version.
+        """
+        where, params = self._where(section_type)
+        if watched is not None:
+            where.append('i.viewCount > 0' if watched else 'i.viewCount = 0')
+        if query:
+            where.append('(i.title LIKE ? OR i.grandparentTitle LIKE ?)')
+            params += ['%%%s%%' % query] * 2
+        if duplicates:
+            where.append('i.ratingKey IN (SELECT ratingKey FROM parts GROUP BY ratingKey '
+                         'HAVING count(DISTINCT media) > 1)')
+
+        sql = ('SELECT %s, p.media, p.file, p.size FROM items i JOIN sections s ON i.section = s.key '
+               'LEFT JOIN parts p ON p.ratingKey = i.ratingKey WHERE %s ORDER BY i.ratingKey' %
+               (', '.join('i."%s"' % c for c in COLUMNS), ' AND '.join(where)))
+
+        current = None
+        for row in self.db.execute(sql, params):
+            if current is None or current.ratingKey != row[0]:
+                if current is not None:
+                    yield current
+                current = Record(parts=(), **dict(zip(COLUMNS, row)))
+            if row[-2] is not None:
+                current.parts += (tuple(row[-3:]),)
+
+        if current is not None:
+            yield current
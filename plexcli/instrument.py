@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Count and time every http request a command makes.
+
+Every requests session goes through Session.send, so that is where we hook
+in: plex.tv, the connection probes, the servers and the downloads. The
+endpoints are grouped by host and path with the numbers taken out, so
+/library/metadata/1 and /library/metadata/2 are the same endpoint. The time
+plexapi spends parsing the xml is kept apart from the time on the network.
+
+Streamed responses are counted when the body has been read or the response
+is closed, with the time spent reading the body. The bulk listings are
+parsed as they stream in, records reports that time with add_parse().
+"""
+
+import json
+import re
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+# Upper bounds of the latency histogram in ms.
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_active = None
+
+
+def active():
+    """The installed Profiler, None when we are not profiling."""
+    return _active
+
+
+def endpoint(method, url):
+    """GET plex.tv/api/v2/user, digits and ratingKey lists are replaced with {}."""
+    u = urlsplit(url)
+    return '%s %s%s' % (method, u.hostname, re.sub(r'\d+(,\d+)*', '{}', u.path))
+
+
+class Stats(object):
+    __slots__ = ('count', 'bytes', 'errors', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, elapsed, size, error=False):
+        self.count += 1
+        self.bytes += size
+        self.errors += error
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        ms = elapsed * 1000
+        self.histogram[next(i for i, b in enumerate(BUCKETS) if ms <= b)] += 1
+
+    def percentile(self, p):
+        """Upper bound in ms of the bucket the p percentile is in."""
+        want = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(BUCKETS, self.histogram):
+            seen += n
+            if seen >= want:
+                return bound
+        return BUCKETS[-1]
+
+    def to_dict(self):
+        return {'count': self.count, 'bytes': self.bytes, 'errors': self.errors,
+                'total_ms': round(self.total * 1000, 1), 'max_ms': round(self.max * 1000, 1),
+                'histogram': dict(('<=%s' % b, n) for b, n in zip(BUCKETS, self.histogram) if n)}
+
+
+class Profiler(object):
+    """Collects the numbers until uninstall().
+
+       Args:
+            cprofile (bool): Also run cProfile, it only sees the main thread.
+    """
+    def __init__(self, cprofile=False):
+        self.endpoints = {}
+        self.parse = Stats()
+        self.started = None
+        self.cprofile = None
+        self._lock = threading.Lock()
+        self._send = None
+        self._parse = None
+        if cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+
+    def install(self):
+        import requests
+
+        global _active
+        _active = profiler = self
+        self.started = time.time()
+        self._send = send = requests.Session.send
+
+        def timed_send(session, request, **kwargs):
+            name = endpoint(request.method, request.url)
+            start = time.time()
+            try:
+                r = send(session, request, **kwargs)
+            except Exception:
+                profiler._add(name, time.time() - start, 0, True)
+                raise
+
+            if kwargs.get('stream'):
+                # Only the headers are here, the body is read later.
+                profiler._watch(r, name, time.time() - start, r.status_code >= 400)
+            else:
+                profiler._add(name, time.time() - start, len(r.content), r.status_code >= 400)
+            return r
+
+        requests.Session.send = timed_send
+
+        try:
+            from plexapi import utils
+            self._parse = parse = utils.parseXMLString
+        except (ImportError, AttributeError):
+            # Older plexapi parses inline, that time ends up in the command.
+            parse = None
+
+        if parse is not None:
+            def timed_parse(s):
+                start = time.time()
+                try:
+                    return parse(s)
+                finally:
+                    profiler.add_parse(time.time() - start, len(s))
+
+            utils.parseXMLString = timed_parse
+
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        return self
+
+    def uninstall(self):
+        global _active
+        if _active is self:
+            _active = None
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self._send is not None:
+            import requests
+            requests.Session.send = self._send
+        if self._parse is not None:
+            from plexapi import utils
+            utils.parseXMLString = self._parse
+
+    def _add(self, name, elapsed, size, error):
+        with self._lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = Stats()
+            self.endpoints[name].add(elapsed, size, error)
+
+    def add_parse(self, elapsed, size):
+        """Time spent parsing size bytes of xml."""
+        with self._lock:
+            self.parse.add(elapsed, size)
+
+    def _watch(self, r, name, elapsed, error):
+        """Add a streamed response when its body is read or it's closed,
+           the time spent in read is added to the time to the headers.
+        """
+        raw = r.raw
+        state = {'elapsed': elapsed, 'size': 0, 'done': False}
+        profiler = self
+
+        def done():
+            if not state['done']:
+                state['done'] = True
+                profiler._add(name, state['elapsed'], state['size'], error)
+
+        def timed(read):
+            def timed_read(*args, **kwargs):
+                start = time.time()
+                try:
+                    data = read(*args, **kwargs)
+                finally:
+                    state['elapsed'] += time.time() - start
+                state['size'] += len(data or b'')
+                if not data:
+                    done()
+                return data
+            return timed_read
+
+        def timed_chunked(read_chunked):
+            def chunks(*args, **kwargs):
+                it = read_chunked(*args, **kwargs)
+                while True:
+                    start = time.time()
+                    try:
+                        data = next(it)
+                    except StopIteration:
+                        break
+                    finally:
+                        state['elapsed'] += time.time() - start
+                    state['size'] += len(data)
+                    yield data
+                done()
+            return chunks
+
+        close = r.close
+
+        def timed_close():
+            try:
+                close()
+            finally:
+                done()
+
+        if raw is not None:
+            raw.read = timed(raw.read)
+            # iter_content reads chunked bodies without read().
+            if hasattr(raw, 'read_chunked'):
+                raw.read_chunked = timed_chunked(raw.read_chunked)
+        r.close = timed_close
+
+    def to_dict(self):
+        network = sum(s.total for s in self.endpoints.values())
+        return {'wall_ms': round((time.time() - self.started) * 1000, 1),
+                # Requests made at the same time are all counted.
+                'network_ms': round(network * 1000, 1),
+                'parse_ms': round(self.parse.total * 1000, 1),
+                'requests': sum(s.count for s in self.endpoints.values()),
+                'bytes': sum(s.bytes for s in self.endpoints.values()),
+                'endpoints': dict((k, s.to_dict()) for k, s in self.endpoints.items())}
+
+    def table(self):
+        """The summary as text, the slowest endpoints first."""
+        lines = ['%-60s %6s %10s %10s %8s %8s %8s' % ('endpoint', 'count', 'bytes', 'total ms', 'p50', 'p95',
+                                                     'max ms')]
+        for name, s in sorted(self.endpoints.items(), key=lambda i: i[1].total, reverse=True):
+            lines.append('%-60s %6s %10s %10.0f %8s %8s %8.0f' % (
+                         name[:60], s.count, s.bytes, s.total * 1000, '<=%s' % s.percentile(50),
+                         '<=%s' % s.percentile(95), s.max * 1000))
+
+        d = self.to_dict()
+        lines.append('%s requests, %s bytes. wall %.0f ms, network %.0f ms, xml parsing %.0f ms' % (
+                     d['requests'], d['bytes'], d['wall_ms'], d['network_ms'], d['parse_ms']))
+        return '\n'.join(lines)
+
+    def report(self, out=None, cprofile_out=None):
+        """Stop and write the json to out, or return the table if out is None."""
+        self.uninstall()
+        if self.cprofile is not None and cprofile_out:
+            self.cprofile.dump_stats(cprofile_out)
+
+        if out:
+            with open(out, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            return
+
+        return self.table()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""Follow the sessions of a server using its notification websocket.
+
+Instead of polling sessions() we keep a table of what's playing and update
+it as the server tells us about it. Only a new session costs a request, the
+rest of the updates are applied to the table as they come in, so a kick rule
+is checked as soon as a playback starts.
+"""
+
+import logging
+import time
+
+
+LOG = logging.getLogger(__file__)
+
+RESOLUTIONS = ('4k', '1080', '720', '576', '480', 'sd')
+
+
+def session_info(session):
+    """The bits of a plexapi session the rules look at."""
+    players = getattr(session, 'players', None) or []
+    media = getattr(session, 'media', None) or []
+    transcodes = getattr(session, 'transcodeSessions', None) or []
+    return {'sessionKey': str(session.sessionKey),
+            'user': ''.join(getattr(session, 'usernames', None) or []),
+            'title': session._prettyfilename() if hasattr(session, '_prettyfilename') else session.title,
+            'player': players[0].title if players else None,
+            'local': bool(players[0].local) if players else None,
+            'resolution': str(media[0].videoResolution or '').lower() if media else '',
+            'transcode': any(t.videoDecision == 'transcode' for t in transcodes),
+            # kbps reserved by the server.
+            'bandwidth': sum(getattr(x, 'bandwidth', None) or 0
+                             for x in getattr(session, 'sessions', None) or []),
+            'state': getattr(players[0], 'state', None) if players else None,
+            'viewOffset': getattr(session, 'viewOffset', None),
+            'item': session}
+
+
+def session_totals(infos):
+    """Number of sessions, how many of them are transcoding and the total bandwidth in kbps."""
+    return {'sessions': len(infos),
+            'transcodes': sum(1 for i in infos if i['transcode']),
+            'bandwidth': sum(i['bandwidth'] for i in infos)}
+
+
+def parse_rule(rule):
+    """Turn a rule like "remote transcode 4k" or "user=bob" into a function that
+       takes a session info and returns True when every condition matches.
+    """
+    checks = []
+    for cond in rule.split():
+        name, _, value = cond.lower().partition('=')
+        if name == 'remote':
+            checks.append(lambda s: s['local'] is False)
+        elif name == 'local':
+            checks.append(lambda s: s['local'] is True)
+        elif name == 'transcode':
+            checks.append(lambda s: s['transcode'])
+        elif name == 'direct':
+            checks.append(lambda s: not s['transcode'])
+        elif name == 'user' and value:
+            checks.append(lambda s, value=value: s['user'].lower() == value)
+        elif name == 'resolution' and value or name in RESOLUTIONS:
+            checks.append(lambda s, value=value or name: s['resolution'] == value)
+        else:
+            raise ValueError('Unknown condition %s in rule %s' % (cond, rule))
+
+    if not checks:
+        raise ValueError('Empty rule')
+    return lambda s: all(check(s) for check in checks)
+
+
+def parse_rules(rules):
+    """Rules separated by ; or a list of rules."""
+    if not rules:
+        return []
+    if isinstance(rules, str):
+        rules = rules.split(';')
+    return [(r.strip(), parse_rule(r)) for r in rules if r.strip()]
+
+
+class SessionTable(object):
+    """What's playing on a server, kept up to date by notifications.
+
+       Args:
+            server (PlexServer): The server we follow.
+            rules (list): of (rule, func) from parse_rules, a session that matches one gets kicked.
+            kick (callable): Called with the session info and the rule to stop it.
+            on_change (callable): Called with the event (start, update, stop) and the session info.
+    """
+    def __init__(self, server, rules=(), kick=None, on_change=None):
+        self.server = server
+        self.rules = list(rules)
+        self.kick = kick
+        self.on_change = on_change
+        self.sessions = {}
+
+    def sync(self):
+        """Rebuild the table from sessions(), on start and after a reconnect."""
+        current = dict((info['sessionKey'], info) for info in map(session_info, self.server.sessions()))
+        for key in set(self.sessions) - set(current):
+            self._emit('stop', self.sessions.pop(key))
+        for key, info in current.items():
+            if key not in self.sessions:
+                self.sessions[key] = info
+                self._emit('start', info)
+                self._check(info)
+
+    def handle(self, data):
+        """Apply a notification from the websocket."""
+        if data.get('type') == 'playing':
+            for n in data.get('PlaySessionStateNotification', []):
+                self._playing(n)
+
+    def _playing(self, n):
+        key = str(n.get('sessionKey'))
+        state = n.get('state')
+        if state == 'stopped':
+            info = self.sessions.pop(key, None)
+            if info is not None:
+                self._emit('stop', info)
+            return
+
+        info = self.sessions.get(key)
+        if info is None:
+            info = self._fetch(key)
+            if info is None:
+                LOG.debug('Session %s is gone already', key)
+                return
+            self.sessions[key] = info
+            event = 'start'
+        else:
+            event = 'update'
+
+        changed = info['state'] != state
+        info['state'] = state
+        info['viewOffset'] = n.get('viewOffset', info['viewOffset'])
+        if event == 'start' or changed:
+            self._emit(event, info)
+        self._check(info)
+
+    def _fetch(self, key):
+        for session in self.server.sessions():
+            if str(session.sessionKey) == key:
+                return session_info(session)
+
+    def _check(self, info):
+        if info.get('kicked') or self.kick is None:
+            return
+        for rule, func in self.rules:
+            if func(info):
+                info['kicked'] = rule
+                self.kick(info, rule)
+                return
+
+    def _emit(self, event, info):
+        if self.on_change is not None:
+            self.on_change(event, info)
+
+
+def _sleep(sec, stop):
+    """Sleep sec, or less if stop() turns True."""
+    end = time.time() + sec
+    while not stop() and time.time() < end:
+        time.sleep(min(0.1, max(end - time.time(), 0)))
+
+
+def listen(server, table, retry=5, stop=None, max_retry=60):
+    """Feed the notifications of server to table until stop() is True,
+       reconnecting with a resync if the websocket drops.
+
+       Args:
+            server (PlexServer): The server we follow.
+            table (SessionTable): Gets the notifications.
+            retry (int): Sec we wait before we reconnect.
+            stop (callable): Stop when it returns True, default never.
+            max_retry (int): The wait is doubled while the server is down, up to this.
+    """
+    try:
+        import websocket  # noqa: F401
+    except ImportError:
+        raise ImportError('monitor needs websocket-client, pip install plex-cli[monitor]')
+    from plexapi.exceptions import PlexApiException
+    from requests.exceptions import RequestException
+
+    stop = stop or (lambda: False)
+    wait = retry
+    while not stop():
+        try:
+            table.sync()
+            listener = server.startAlertListener(table.handle)
+        except (RequestException, PlexApiException) as e:
+            # Most likely the server is restarting.
+            LOG.warning('Failed to reconnect %s, trying again in %s sec', e, wait)
+            _sleep(wait, stop)
+            wait = min(wait * 2, max_retry)
+            continue
+
+        wait = retry
+        try:
+            while listener.is_alive() and not stop():
+                listener.join(1)
+        finally:
+            if listener.is_alive():
+                listener.stop()
+
+        if not stop():
+            LOG.warning('Lost the notification websocket, reconnecting in %s sec', retry)
+            _sleep(retry, stop)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Plans for destructive operations.
+
+A plan is a json lines file, the first line says what server it's for and
+every line after that is a operation. Writing the plan and applying it are
+separate steps so the expensive scan and the review dont have to happen in
+the same run. What has been applied is appended to a .done file next to the
+plan so a crashed run picks up where it stopped.
+"""
+
+import json
+import os
+import time
+
+from .executor import AdaptiveExecutor
+
+
+DELETE_ITEM = 'delete_item'
+DELETE_MEDIA = 'delete_media'
+# Delete a item, but only if it's still watched when the plan is applied.
+DELETE_WATCHED = 'delete_watched'
+
+
+def op(action, ratingKey, media=None, file=None, size=0):
+    return {'action': action, 'ratingKey': ratingKey, 'media': media, 'file': file, 'size': size}
+
+
+def write_plan(path, server, ops):
+    """Write ops for server to path, returns the number of ops."""
+    count = 0
+    with open(path, 'w') as f:
+        f.write(json.dumps({'server': server.machineIdentifier, 'name': server.friendlyName,
+                            'created': int(time.time())}) + '\n')
+        for o in ops:
+            f.write(json.dumps(o, separators=(',', ':')) + '\n')
+            count += 1
+
+    done = '%s.done' % path
+    if os.path.exists(done):
+        os.remove(done)
+    return count
+
+
+def read_plan(path):
+    """Returns the header and the list of ops."""
+    with open(path) as f:
+        header = json.loads(f.readline())
+        ops = [json.loads(line) for line in f if line.strip()]
+    return header, ops
+
+
+def read_done(path):
+    """The index of the ops that has been applied."""
+    try:
+        with open('%s.done' % path) as f:
+            return set(int(line) for line in f if line.strip())
+    except (IOError, OSError):
+        return set()
+
+
+def run_op(server, o):
+    """Apply a single op, something that is already gone counts as done.
+
+       Returns False if the op was skipped, a item of a delete_watched
+       that has been marked as unwatched since the plan was written.
+    """
+    from plexapi.exceptions import NotFound
+
+    if o['action'] == DELETE_MEDIA:
+        key = '/library/metadata/%s/media/%s' % (o['ratingKey'], o['media'])
+    elif o['action'] in (DELETE_ITEM, DELETE_WATCHED):
+        key = '/library/metadata/%s' % o['ratingKey']
+    else:
+        raise ValueError('Unknown action %s' % o['action'])
+
+    try:
+        if o['action'] == DELETE_WATCHED and not server.fetchItem(int(o['ratingKey'])).viewCount:
+            return False
+        server.query(key, method=server._session.delete)
+    except NotFound:
+        pass
+    return True
+
+
+def apply_plan(server, path, executor=None, callback=None):
+    """Apply the ops in the plan at path that are not done yet.
+
+       Args:
+            server (PlexServer): The server from the plan.
+            path (str): The plan.
+            executor (AdaptiveExecutor): Runs the ops, default a new one.
+            callback (callable): Called with each op when it's done and
+                                 False if it was skipped.
+
+       Returns:
+            list: of (op, error) for the ops that failed.
+    """
+    executor = executor or AdaptiveExecutor()
+    _, ops = read_plan(path)
+    done = read_done(path)
+    todo = [(i, o) for i, o in enumerate(ops) if i not in done]
+    failed = []
+
+    with open('%s.done' % path, 'a') as checkpoint:
+        for (i, o), applied, error in executor.map(lambda task: run_op(server, task[1]), todo):
+            if error is not None:
+                failed.append((o, error))
+                continue
+
+            checkpoint.write('%s\n' % i)
+            checkpoint.flush()
+            if callback is not None:
+                callback(o, applied)
+
+    return failed
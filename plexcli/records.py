@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""Light weight records for bulk commands.
+
+Building a plexapi object for every row of a 100k item section is slow and
+uses a lot of memory. Most bulk commands only need a handful of attributes,
+so we parse the xml as it streams in and keep those in small slotted records.
+A record can be turned into the real plexapi object when we need to change it.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import iterparse
+
+from . import instrument
+from .utils import PAGE_SIZE
+
+
+FIELDS = ('ratingKey', 'guid', 'type', 'title', 'year', 'grandparentTitle', 'parentIndex',
+          'index', 'viewCount', 'lastViewedAt', 'addedAt', 'updatedAt', 'rating', 'section', 'parts')
+INTS = ('ratingKey', 'year', 'parentIndex', 'index', 'viewCount', 'lastViewedAt', 'addedAt',
+        'updatedAt')
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Record(object):
+    """The bits of a library item the bulk commands needs.
+
+       parts is a tuple of (media id, file, size).
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, **kwargs):
+        for field in FIELDS:
+            setattr(self, field, kwargs.get(field))
+
+    @classmethod
+    def from_attrib(cls, attrib, section=None):
+        record = cls(section=section, parts=())
+        for field in FIELDS[:-2]:
+            value = attrib.get(field)
+            setattr(record, field, _int(value) if field in INTS else value)
+
+        record.rating = _float(attrib.get('rating') or attrib.get('audienceRating'))
+        record.viewCount = record.viewCount or 0
+        return record
+
+    @property
+    def size(self):
+        return sum(size for _, _, size in self.parts)
+
+    @property
+    def file(self):
+        return self.parts[0][1] if self.parts else None
+
+    def _prettyfilename(self):
+        if self.type == 'episode':
+            return '%s - s%se%s - %s' % (self.grandparentTitle, str(self.parentIndex).zfill(2),
+                                         str(self.index).zfill(2), self.title)
+        if self.year:
+            return '%s (%s)' % (self.title, self.year)
+        return self.title
+
+    def item(self, server):
+        """The full plexapi object, this is a request to the server."""
+        return server.fetchItem(self.ratingKey)
+
+    def mark_watched(self, server):
+        """Mark as watched on server, the ratingKey is all we need so
+           there is no need to fetch the item first.
+        """
+        server.query('/:/scrobble?key=%s&identifier=com.plexapp.plugins.library' % self.ratingKey)
+
+    def __repr__(self):
+        return '<Record:%s:%s>' % (self.ratingKey, self.title)
+
+
+def parse_records(source, container=None):
+    """Parse a MediaContainer from a file like object into records as it streams in.
+
+       container is called with the attributes of the MediaContainer before
+       the first record.
+    """
+    depth = 0
+    root = None
+    section = None
+    current = None
+    media = None
+    parts = []
+
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+                section = _int(elem.attrib.get('librarySectionID'))
+                if container is not None:
+                    container(elem.attrib)
+            elif depth == 2:
+                current = Record.from_attrib(elem.attrib, section)
+                parts = []
+            elif elem.tag == 'Media':
+                media = _int(elem.attrib.get('id'))
+            elif elem.tag == 'Part' and current is not None:
+                parts.append((media, elem.attrib.get('file'), _int(elem.attrib.get('size')) or 0))
+        else:
+            depth -= 1
+            if depth == 1 and current is not None:
+                current.parts = tuple(parts)
+                yield current
+                current = None
+                # Drop what we have parsed so far.
+                root.clear()
+
+
+class _Timed(object):
+    """File like that keeps the time spent reading and the bytes read."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.elapsed = 0
+        self.size = 0
+
+    def read(self, *args):
+        start = time.time()
+        try:
+            data = self.raw.read(*args)
+        finally:
+            self.elapsed += time.time() - start
+        self.size += len(data)
+        return data
+
+
+def _profiled(profiler, raw, container):
+    """parse_records that adds the time it spent parsing to the profiler,
+       the time waiting on the network is taken out.
+    """
+    source = _Timed(raw)
+    records = parse_records(source, container)
+    elapsed = 0
+    try:
+        while True:
+            start = time.time()
+            try:
+                record = next(records)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+            yield record
+    finally:
+        profiler.add_parse(elapsed - source.elapsed, source.size)
+
+
+def _request(server, key, start, size):
+    headers = server._headers(**{'X-Plex-Container-Start': str(start),
+                                 'X-Plex-Container-Size': str(size)})
+    r = server._session.get(server.url(key), headers=headers, stream=True, timeout=server._timeout)
+    r.raw.decode_content = True
+    return r
+
+
+def _close(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def iter_records(server, key, page_size=PAGE_SIZE, prefetch=True):
+    """Stream a library key from the server as records, page_size items per request.
+
+       Args:
+            server (PlexServer): The server to ask.
+            key (str): Library key, like /library/sections/1/all
+            page_size (int): Number of items in each request.
+            prefetch (bool): Ask for the next page as soon as we know there is one,
+                             so the server works on it while we parse this one.
+    """
+    profiler = instrument.active()
+    pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    start = 0
+    nxt = []
+    r = _request(server, key, start, page_size)
+    try:
+        while r is not None:
+            total = []
+
+            def container(attrib):
+                total.append(_int(attrib.get('totalSize')))
+                if pool is not None and total[0] is not None and start + page_size < total[0]:
+                    nxt.append(pool.submit(_request, server, key, start + page_size, page_size))
+
+            count = 0
+            try:
+                r.raise_for_status()
+                if profiler is None:
+                    records = parse_records(r.raw, container)
+                else:
+                    records = _profiled(profiler, r.raw, container)
+                for record in records:
+                    count += 1
+                    yield record
+            finally:
+                r.close()
+
+            start += page_size
+            if nxt:
+                r = nxt.pop().result()
+            elif count < page_size or (total and total[0] is not None and start >= total[0]):
+                r = None
+            else:
+                r = _request(server, key, start, page_size)
+    finally:
+        # Stopped early, dont leave the prefetched page holding a connection.
+        for future in nxt:
+            future.add_done_callback(_close)
+        if pool is not None:
+            pool.shutdown(wait=False)
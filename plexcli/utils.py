@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import math
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import click
-from plexapi.video import Episode, Movie, Show
-from plexapi.utils import download as utils_download
+
+
+PAGE_SIZE = 500
+# Worth retrying, the server or a proxy in front of it is busy.
+RETRY_STATUS = (429, 500, 502, 503, 504)
 
 
 def prompt(msg, items):
@@ -44,18 +56,25 @@ def double_confirm(msg):
     return ans
 
 
-def _download(items, path=None):
-    locs = []
+def _download(items, path=None, connections=4, workers=2, limit=None):
+    from .download import download_many
+
+    path = path or os.getcwd()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    jobs = []
     for item in items:
         parts = [i for i in item.iterParts() if i]
         for part in parts:
-            filename = '%s.%s' % (item._prettyfilename(), part.container)
-            url = item._server.url('%s?download=1' % part.key)
-            filepath = utils_download(url, filename=filename, savepath=path,
-                                      session=item._server._session, showstatus=True)
-            locs.append(filepath)
+            jobs.append({'url': item._server.url('%s?download=1' % part.key),
+                         'filename': '%s.%s' % (item._prettyfilename(), part.container),
+                         'size': part.size,
+                         'session': item._server._session,
+                         'headers': {'X-Plex-Token': item._server._token}})
 
-    return locs
+    return download_many(jobs, path, workers=workers, connections=connections,
+                         limit=parse_size(limit) if limit else None)
 
 
 def choose(msg, items, attr):
@@ -97,6 +116,8 @@ def choose(msg, items, attr):
 
 
 def select(results):
+    from plexapi.video import Show
+
     final = []
     result = choose('Choose result', results, lambda x: '(%s) %s %s' %
                     (x.type.title(), x.title[0:60], x._server.friendlyName))
@@ -110,6 +131,75 @@ def select(results):
     return final
 
 
+def parse_size(size):
+    """Parse a human size like 2TB, 1.5 GB or 500M to bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    size = size.strip().upper().rstrip('B').rstrip('I')
+    units = 'KMGTPEZY'
+    if size and size[-1] in units:
+        return int(float(size[:-1].strip()) * 1024 ** (units.index(size[-1]) + 1))
+    return int(float(size))
+
+
+def parse_list(value):
+    """A comma separated list as a list, fire already turns show,movie into
+       the tuple ('show', 'movie') so that is taken too. None stays None.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, (list, tuple)):
+        value = str(value).split(',')
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def timestamp(value):
+    """Epoch from a int or datetime, 0 for None."""
+    if value is None:
+        return 0
+    if hasattr(value, 'timetuple'):
+        return int(time.mktime(value.timetuple()))
+    return int(value)
+
+
+PRIORITIES = {
+    'size': lambda c: -c['size'],
+    'oldest': lambda c: c['lastViewedAt'] or 0,
+    'rating': lambda c: c['rating'] if c['rating'] is not None else float('inf'),
+}
+
+
+def pick_free(candidates, target, priority='size'):
+    """Pick the candidates to delete to free up target bytes.
+
+       candidates are dicts with size, lastViewedAt and rating. They are taken
+       in priority order (size: biggest, oldest: oldest watched, rating: lowest
+       rated first) until we have enough, then the smallest ones we didnt need
+       after all are put back.
+
+       Returns:
+            (list of picked candidates, bytes freed)
+    """
+    order = sorted(candidates, key=lambda c: (PRIORITIES[priority](c), -c['size']))
+    picked = []
+    freed = 0
+    for c in order:
+        if freed >= target:
+            break
+        picked.append(c)
+        freed += c['size']
+
+    drop = set()
+    for i in sorted(range(len(picked)), key=lambda i: picked[i]['size']):
+        if freed - picked[i]['size'] < target:
+            break
+        freed -= picked[i]['size']
+        drop.add(i)
+
+    return [c for i, c in enumerate(picked) if i not in drop], freed
+
+
 def convert_size(size_bytes):
     # stole from stackoverflow
     if size_bytes == 0:
@@ -122,7 +212,263 @@ def convert_size(size_bytes):
 
 
 
-def get_genre(item):
+def section_key(section, watched=False, since=None):
+    """Build the key for every playable item in a section.
+       Shows are listed as episodes so we dont have to walk
+       every show and season.
+
+       since (int) only includes items viewed after that timestamp.
+    """
+    key = '/library/sections/%s/all' % section.key
+    filters = []
+    if section.TYPE == 'show':
+        filters.append('type=4')
+    if watched:
+        filters.append('viewCount>=0')
+    if since:
+        filters.append('lastViewedAt>>=%s' % since)
+    if filters:
+        key += '?' + '&'.join(filters)
+    return key
+
+
+def count_items(server, key):
+    """Number of items in a library key, without fetching them."""
+    data = server.query(key, headers={'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': '0'})
+    return int(data.attrib.get('totalSize', len(data)))
+
+
+def guid_index(items):
+    """Map guid -> item so we can match items between servers without
+       asking the server for every single item.
+    """
+    index = {}
+    for item in items:
+        if item.guid:
+            index[item.guid] = item
+    return index
+
+
+def fan_out(func, items, workers=8, timeout=None, stop=None):
+    """Call func on every item using daemon threads.
+
+       Yields (item, result, error) as soon as each call finishes. A call that
+       has been running longer than timeout is yielded with a TimeoutError and
+       left behind so it can't hang the caller. stop is called every 0.1 sec,
+       when it returns True the calls that are still running are left behind.
+       The threads are daemons, so a call we left behind doesnt keep the
+       process alive when we are done.
+    """
+    items = list(items)
+    todo = queue.Queue()
+    for job in enumerate(items):
+        todo.put(job)
+    results = queue.Queue()
+    started = {}
+    left = []
+
+    def work():
+        while not left:
+            try:
+                idx, item = todo.get_nowait()
+            except queue.Empty:
+                return
+            started[idx] = time.time()
+            try:
+                results.put((idx, func(item), None))
+            except Exception as e:
+                results.put((idx, None, e))
+
+    for _ in range(min(workers, len(items))):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    pending = set(range(len(items)))
+    try:
+        while pending:
+            done = []
+            try:
+                done.append(results.get(timeout=0.1))
+                while True:
+                    done.append(results.get_nowait())
+            except queue.Empty:
+                pass
+
+            for idx, result, error in done:
+                if idx in pending:
+                    pending.discard(idx)
+                    yield items[idx], result, error
+
+            if stop is not None and stop():
+                break
+
+            if timeout is None:
+                continue
+
+            now = time.time()
+            for idx in sorted(pending):
+                if idx in started and now - started[idx] > timeout:
+                    pending.discard(idx)
+                    yield items[idx], None, TimeoutError('No answer in %s sec' % timeout)
+    finally:
+        # Dont start what's still queued.
+        left.append(True)
+
+
+def resource_to_dict(resource):
+    """Strip a MyPlexResource down to what we need to connect to it later."""
+    return {'name': resource.name,
+            'clientIdentifier': resource.clientIdentifier,
+            'provides': resource.provides,
+            'owned': resource.owned,
+            'accessToken': resource.accessToken,
+            'connections': [{'uri': c.uri, 'local': c.local, 'relay': getattr(c, 'relay', False)}
+                            for c in resource.connections],
+            'uri': None}
+
+
+def location(connection):
+    """local, remote or relay."""
+    if connection.get('relay'):
+        return 'relay'
+    return 'local' if connection.get('local') else 'remote'
+
+
+def make_session(pool_size=16, retries=3, backoff=0.5):
+    """A session we share with every server, so the connections are kept
+       alive and reused by paging and the thread pools.
+
+       Only GET and HEAD are retried, the mutations are retried by the
+       AdaptiveExecutor and we dont want to do that twice. Only the status
+       codes are retried, a connect or read timeout is not. The probes and
+       the cached uri share this session and a dead address should fail
+       after one timeout.
+
+       Args:
+            pool_size (int): Max connections we keep open to each host.
+            retries (int): How many times a failed request is retried.
+            backoff (float): Backoff factor between the retries, sec.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    kwargs = dict(total=retries, connect=0, read=0, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUS, raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET', 'HEAD']), **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET', 'HEAD']), **kwargs)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+
+def probe(uri, token, timeout=5, session=None):
+    """Time a request to /identity, returns the latency in sec or None if it failed."""
+    import requests
+
+    start = time.time()
+    try:
+        r = (session or requests).get('%s/identity' % uri.rstrip('/'), headers={'X-Plex-Token': token}, timeout=timeout)
+        r.raise_for_status()
+    except requests.RequestException:
+        return None
+    return time.time() - start
+
+
+def score(connection, latency, weight=0.3):
+    """Update the rolling latency and health of a connection,
+       latency None means the probe failed.
+    """
+    health = connection.get('health', 1.0)
+    connection['health'] = round((1 - weight) * health + weight * (latency is not None), 3)
+    if latency is not None:
+        old = connection.get('latency')
+        connection['latency'] = latency if old is None else round((1 - weight) * old + weight * latency, 4)
+    return connection
+
+
+def rank_connections(connections, prefer=None):
+    """Sort connections with the preferred location first, then by latency
+       where flaky connections are punished by their health.
+    """
+    def cost(c):
+        latency = c.get('latency')
+        if latency is None:
+            latency = float('inf')
+        return (bool(prefer) and location(c) != prefer, latency / max(c.get('health', 1.0), 0.1))
+
+    return sorted(connections, key=cost)
+
+
+def fetch_metadata(server, keys, size=100):
+    """Fetch the full metadata (with streams and genres) for many ratingKeys
+       using /library/metadata/1,2,3 so we dont need a request per item.
+
+       plexapi sees the items as partial because of the key, so reading an
+       attribute that is None would reload the item. They are complete,
+       so that is turned off.
+    """
+    items = []
+    keys = list(keys)
+    for i in range(0, len(keys), size):
+        items += server.fetchItems('/library/metadata/%s' % ','.join(str(k) for k in keys[i:i + size]))
+    for item in items:
+        item._autoReload = False
+    return items
+
+
+def match_keys(item):
+    """The keys we match items between servers on, the guid and
+       title + year (show, season and episode for episodes) as a fallback.
+    """
+    keys = []
+    # Local guids are only unique on that server.
+    if item.guid and not item.guid.startswith(('local://', 'com.plexapp.agents.none')):
+        keys.append(item.guid)
+
+    if item.type == 'episode':
+        keys.append((item.type, (item.grandparentTitle or '').lower(), item.parentIndex, item.index))
+    else:
+        keys.append((item.type, (item.title or '').lower(), item.year))
+    return keys
+
+
+def compare(mine, yours):
+    """Compare two lists of items in linear time.
+
+       Yields (where, item) where is mine, yours or both.
+    """
+    your_keys = set(k for item in yours for k in match_keys(item))
+    my_keys = set()
+    for item in mine:
+        keys = match_keys(item)
+        my_keys.update(keys)
+        yield ('both' if any(k in your_keys for k in keys) else 'mine'), item
+
+    for item in yours:
+        if not any(k in my_keys for k in match_keys(item)):
+            yield 'yours', item
+
+
+def get_genre(item, cache=None):
+    """Genres of a item, episodes uses the genres of the show.
+       Pass a dict as cache to only fetch each show once.
+    """
     if item.TYPE == 'episode':
-        return item.show().genres
+        if cache is None:
+            return item.show().genres
+
+        key = item.grandparentRatingKey
+        if key not in cache:
+            cache[key] = item.show().genres
+        return cache[key]
+
     return item.genres
@@ -15,7 +15,9 @@ requirements = [
     'Click>=6.0',
     'tqdm',
     'plexapi',
-    'fire'
+    'requests',
+    'fire',
+    'futures; python_version < "3.0"',
     # TODO: put package requirements here
 ]
 
@@ -40,11 +42,15 @@ setup(
     packages=find_packages(include=['plex-cli']),
     entry_points={
         'console_scripts': [
-            'plex-cli=plexcli.cli:main'
+            'plex-cli=plexcli.cli:main',
+            'plex-cli-client=plexcli.client:main',
         ]
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'monitor': ['websocket-client'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='plexcli',
@@ -3,12 +3,19 @@
 
 """Tests for `plexcli` package."""
 
+import os
+import time
+
 import pytest
 
 from click.testing import CliRunner
 
 from plexcli import plexcli
 from plexcli import cli
+from plexcli import utils
+from plexcli import cache
+from plexcli import download
+from plexcli import records
 
 
 @pytest.fixture
@@ -36,3 +43,1028 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+class FakeItem(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_section_key():
+    show = FakeItem(key=1, TYPE='show')
+    movie = FakeItem(key=2, TYPE='movie')
+    assert utils.section_key(show) == '/library/sections/1/all?type=4'
+    assert utils.section_key(show, watched=True) == '/library/sections/1/all?type=4&viewCount>=0'
+    assert utils.section_key(movie, watched=True) == '/library/sections/2/all?viewCount>=0'
+    assert utils.section_key(movie, since=10) == '/library/sections/2/all?lastViewedAt>>=10'
+
+
+def test_guid_index():
+    items = [FakeItem(guid='a', title='A'), FakeItem(guid=None, title='B'),
+             FakeItem(guid='c', title='C')]
+    index = utils.guid_index(items)
+    assert sorted(index) == ['a', 'c']
+    assert index['c'].title == 'C'
+
+
+def test_fan_out():
+    import time
+
+    def work(i):
+        if i == 2:
+            raise ValueError('boom')
+        if i == 3:
+            time.sleep(2)
+        return i * 2
+
+    result = dict((item, (res, err)) for item, res, err in utils.fan_out(work, range(4), timeout=0.5))
+    assert result[0] == (0, None)
+    assert result[1] == (2, None)
+    assert isinstance(result[2][1], ValueError)
+    assert isinstance(result[3][1], utils.TimeoutError)
+
+
+def test_fan_out_exit():
+    import subprocess
+    import sys
+
+    # The call we gave up on must not keep the process alive.
+    code = ('import time; from plexcli.utils import fan_out; '
+            'print(list(fan_out(time.sleep, [4], timeout=0.5))[0][2])')
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert time.time() - start < 3
+    assert 'No answer' in out.decode()
+
+
+def test_token_cache(tmpdir, monkeypatch):
+    import os
+    import stat
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir.join('cache')))
+    assert cache.get_token('user') is None
+    cache.set_token('user', 'abc')
+    assert cache.get_token('user') == 'abc'
+    mode = os.stat(os.path.join(cache.CACHE_DIR, cache.TOKENS)).st_mode
+    assert stat.S_IMODE(mode) == stat.S_IRUSR | stat.S_IWUSR
+    cache.del_token('user')
+    assert cache.get_token('user') is None
+
+
+def test_resource_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    resource = {'name': 'pms', 'clientIdentifier': 'x', 'uri': None,
+                'connections': [{'uri': 'http://a', 'local': True, 'relay': False}]}
+    assert cache.get_resources('user') is None
+    cache.set_resources('user', [dict(resource)])
+    cache.set_uri('user', 'x', 'http://a')
+    assert cache.get_resources('user')[0]['uri'] == 'http://a'
+    assert cache.get_resources('user', ttl=-1) is None
+    # The working uri survives a refresh from plex.tv.
+    cache.set_resources('user', [dict(resource)])
+    assert cache.get_resources('user')[0]['uri'] == 'http://a'
+
+
+def test_resource_cache_threads(tmpdir, monkeypatch):
+    import threading
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    ids = [str(i) for i in range(20)]
+    cache.set_resources('user', [{'name': i, 'clientIdentifier': i, 'uri': None, 'connections': []}
+                                 for i in ids])
+    threads = [threading.Thread(target=cache.set_uri, args=('user', i, 'http://%s' % i)) for i in ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # No update is lost and no tmp file is left behind.
+    assert [r['uri'] for r in cache.get_resources('user')] == ['http://%s' % i for i in ids]
+    assert os.listdir(str(tmpdir)) == [cache.RESOURCES]
+
+
+def test_race_blackhole(tmpdir, monkeypatch):
+    import socket
+    from benchmarks import fakeplex
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(cli.CLI, '_warm', None)
+    # Takes the connection but never answers, like a dead relay.
+    blackhole = socket.socket()
+    blackhole.bind(('127.0.0.1', 0))
+    blackhole.listen(1)
+    try:
+        with fakeplex.FakePlex(fakeplex.Library(1), name='a') as fake:
+            resource = fake.resource()
+            dead = {'uri': 'http://127.0.0.1:%s' % blackhole.getsockname()[1], 'local': False, 'relay': True}
+            resource['connections'].insert(0, dead)
+            cache.set_resources('user', [resource])
+
+            start = time.time()
+            ranked = cli.CLI(username='user')._race(resource, timeout=5)
+            assert time.time() - start < 2
+            assert [c['uri'] for c in ranked] == [fake.url]
+    finally:
+        blackhole.close()
+
+
+def test_rank_connections():
+    local = utils.score({'uri': 'http://local', 'local': True}, 0.05)
+    remote = utils.score({'uri': 'https://remote'}, 0.02)
+    relay = utils.score({'uri': 'https://relay', 'relay': True}, 0.5)
+    flaky = {'uri': 'https://flaky', 'latency': 0.01, 'health': 0.1}
+    ranked = utils.rank_connections([relay, local, flaky, remote])
+    assert [c['uri'] for c in ranked] == ['https://remote', 'http://local', 'https://flaky', 'https://relay']
+    ranked = utils.rank_connections([relay, local, remote], prefer='local')
+    assert ranked[0] is local
+    assert utils.score(local, None)['health'] < 1
+
+
+@pytest.fixture
+def range_server():
+    """Serve a blob with support for Range requests."""
+    import threading
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    blob = bytes(bytearray(i % 251 for i in range(100000)))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start, end = 0, len(blob) - 1
+            rng = self.headers.get('Range')
+            if rng:
+                start, end = [int(i) for i in rng.split('=')[1].split('-')]
+            self.send_response(206 if rng else 200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(blob)))
+            self.end_headers()
+            self.wfile.write(blob[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    yield 'http://127.0.0.1:%s/file' % server.server_port, blob
+    server.shutdown()
+
+
+def test_ranged_download(tmpdir, range_server):
+    import json
+
+    url, blob = range_server
+    filepath = str(tmpdir.join('file.mkv'))
+    assert download.chunks(10, 4) == [(0, 0, 3), (1, 4, 7), (2, 8, 9)]
+
+    # Pretend we were interrupted after the first chunk.
+    with open(filepath + '.part', 'wb') as f:
+        f.write(blob[:30000])
+        f.truncate(len(blob))
+    with open(filepath + '.state', 'w') as f:
+        json.dump({'size': len(blob), 'chunk_size': 30000, 'done': [0]}, f)
+
+    assert download.download(url, filepath, connections=3, chunk_size=30000) == filepath
+    with open(filepath, 'rb') as f:
+        assert f.read() == blob
+    assert not tmpdir.join('file.mkv.state').exists()
+
+
+def test_parse_size():
+    assert utils.parse_size(10) == 10
+    assert utils.parse_size('500') == 500
+    assert utils.parse_size('2KB') == 2048
+    assert utils.parse_size('1.5 GiB') == int(1.5 * 1024 ** 3)
+    assert utils.parse_size('2t') == 2 * 1024 ** 4
+
+
+def test_parse_list():
+    import fire
+    # What fire gives the commands for --section_type show,movie
+    parsed = fire.Fire(lambda section_type=None: section_type, command=['--section_type', 'show,movie'])
+    assert utils.parse_list(parsed) == utils.parse_list('show, movie') == ['show', 'movie']
+    assert utils.parse_list('movie') == ['movie']
+    assert utils.parse_list(None) is None
+
+
+def test_download_many_skips_completed(tmpdir, range_server):
+    url, blob = range_server
+    jobs = [{'url': url, 'filename': 'a.mkv', 'size': len(blob)},
+            {'url': url, 'filename': 'b.mkv', 'size': len(blob)}]
+    locs = download.download_many(jobs, str(tmpdir), workers=2, showstatus=False)
+    assert sorted(locs) == sorted(str(tmpdir.join(i)) for i in ('a.mkv', 'b.mkv'))
+
+    tmpdir.join('a.mkv').write('broken')
+    manifest = download.Manifest(str(tmpdir))
+    assert not manifest.complete(str(tmpdir.join('a.mkv')), len(blob))
+    assert manifest.complete(str(tmpdir.join('b.mkv')), len(blob))
+
+
+def test_get_genre_cache():
+    calls = []
+
+    def show():
+        calls.append(1)
+        return ['Family']
+
+    episode = FakeItem(TYPE='episode', grandparentRatingKey=1, show=lambda: FakeItem(genres=show()))
+    genres = {}
+    assert utils.get_genre(episode, genres) == ['Family']
+    assert utils.get_genre(episode, genres) == ['Family']
+    assert len(calls) == 1
+    assert utils.get_genre(FakeItem(TYPE='movie', genres=['Kids'])) == ['Kids']
+
+
+def test_fetch_metadata():
+    server = FakeItem(fetchItems=lambda key: [FakeItem(key=key)])
+    items = utils.fetch_metadata(server, range(5), size=2)
+    assert [i.key for i in items] == ['/library/metadata/0,1', '/library/metadata/2,3', '/library/metadata/4']
+    assert all(i._autoReload is False for i in items)
+
+
+class FakePagedServer(object):
+    """Serve range(total) as records in pages like pms does."""
+    def __init__(self, total):
+        import threading
+        self.total = total
+        self.requests = []
+        self.open = 0
+        self._lock = threading.Lock()
+        self._session = self
+        self._timeout = None
+
+    def _headers(self, **kwargs):
+        return kwargs
+
+    def url(self, key):
+        return key
+
+    def _page(self, start, size):
+        from xml.etree import ElementTree
+        data = ElementTree.Element('MediaContainer', totalSize=str(self.total))
+        for i in range(start, min(start + size, self.total)):
+            ElementTree.SubElement(data, 'Video', ratingKey=str(i))
+        return data
+
+    def query(self, key, headers=None):
+        return self._page(int(headers['X-Plex-Container-Start']), int(headers['X-Plex-Container-Size']))
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        import io
+        from xml.etree import ElementTree
+        start = int(headers['X-Plex-Container-Start'])
+        size = int(headers['X-Plex-Container-Size'])
+        with self._lock:
+            self.requests.append((start, size))
+            self.open += 1
+        body = ElementTree.tostring(self._page(start, size))
+        server = self
+
+        def close():
+            with server._lock:
+                server.open -= 1
+
+        return FakeItem(raw=io.BytesIO(body), raise_for_status=lambda: None, close=close)
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_iter_records_pages(prefetch):
+    server = FakePagedServer(25)
+    keys = [r.ratingKey for r in records.iter_records(server, '/all', page_size=10, prefetch=prefetch)]
+    assert keys == list(range(25))
+    assert sorted(server.requests) == [(0, 10), (10, 10), (20, 10)]
+    assert utils.count_items(server, '/all') == 25
+
+    # The last page is full, totalSize tells us we are done.
+    server = FakePagedServer(20)
+    assert len(list(records.iter_records(server, '/all', page_size=10, prefetch=prefetch))) == 20
+    assert sorted(server.requests) == [(0, 10), (10, 10)]
+
+
+def test_iter_records_stop_early():
+    server = FakePagedServer(25)
+    it = records.iter_records(server, '/all', page_size=10)
+    assert next(it).ratingKey == 0
+    # The next page is asked for while we are on the first one.
+    for _ in range(50):
+        if len(server.requests) == 2:
+            break
+        time.sleep(0.01)
+    assert server.requests == [(0, 10), (10, 10)]
+
+    it.close()
+    # The prefetched page is closed too.
+    for _ in range(50):
+        if not server.open:
+            break
+        time.sleep(0.01)
+    assert server.open == 0
+
+
+def test_parse_records():
+    import io
+
+    xml = b'''<MediaContainer size="2" librarySectionID="3">
+      <Video ratingKey="10" guid="plex://episode/1" type="episode" title="Pilot"
+             grandparentTitle="Show" parentIndex="1" index="2" viewCount="3" lastViewedAt="1500">
+        <Media id="1"><Part file="/a.mkv" size="100"/></Media>
+        <Media id="2"><Part file="/b.mkv" size="50"/></Media>
+      </Video>
+      <Video ratingKey="11" guid="plex://movie/1" type="movie" title="Movie" year="1999"/>
+    </MediaContainer>'''
+    episode, movie = list(records.parse_records(io.BytesIO(xml)))
+    assert (episode.ratingKey, episode.section, episode.viewCount) == (10, 3, 3)
+    assert episode.size == 150 and episode.file == '/a.mkv'
+    assert episode.parts == ((1, '/a.mkv', 100), (2, '/b.mkv', 50))
+    assert episode._prettyfilename() == 'Show - s01e02 - Pilot'
+    assert movie.viewCount == 0 and movie.parts == ()
+    assert movie._prettyfilename() == 'Movie (1999)'
+    assert not hasattr(movie, '__dict__')
+
+
+def test_index(tmpdir, monkeypatch):
+    from plexcli import index
+
+    def rec(key, **kwargs):
+        kwargs.setdefault('viewCount', 0)
+        kwargs.setdefault('updatedAt', 100)
+        return records.Record(ratingKey=key, guid='g%s' % key, type='movie', title='Movie %s' % key,
+                              **kwargs)
+
+    library = {1: rec(1, parts=((1, '/a', 10),)),
+               2: rec(2, viewCount=1, lastViewedAt=50, parts=((2, '/b', 10), (3, '/c', 5)))}
+    keys = []
+
+    def fake_records(server, key, page_size=None):
+        keys.append(key)
+        if 'updatedAt>>=' in key:
+            return [r for r in library.values() if r.updatedAt > int(key.split('>>=')[1])]
+        if 'lastViewedAt>>=' in key:
+            return [r for r in library.values() if (r.lastViewedAt or 0) > int(key.split('>>=')[1])]
+        return list(library.values())
+
+    monkeypatch.setattr(index, 'iter_records', fake_records)
+    monkeypatch.setattr(index, 'count_items', lambda server, key: len(library))
+    section = FakeItem(key=1, TYPE='movie', title='Movies')
+    server = FakeItem(machineIdentifier='abc', library=FakeItem(sections=lambda: [section]))
+
+    idx = index.Index(server, path=str(tmpdir.join('index.db')))
+    idx.refresh()
+    assert keys == ['/library/sections/1/all']
+    assert idx.count() == 2
+    assert [r.ratingKey for r in idx.records(watched=True)] == [2]
+    dupe, = idx.records(duplicates=True)
+    assert dupe.parts == ((2, '/b', 10), (3, '/c', 5)) and dupe.size == 15
+
+    # Only what changed is fetched.
+    del keys[:]
+    library[1] = rec(1, viewCount=1, lastViewedAt=200, updatedAt=100, parts=((1, '/a', 10),))
+    idx.refresh()
+    assert keys == ['/library/sections/1/all?updatedAt>>=99', '/library/sections/1/all?lastViewedAt>>=49']
+    assert idx.count(section_type=['movie']) == 2
+    assert [r.ratingKey for r in idx.records(watched=True)] == [1, 2]
+    assert [r.ratingKey for r in idx.records(query='movie 2')] == [2]
+
+    idx.discard(2)
+    assert [r.ratingKey for r in idx.records()] == [1]
+
+
+
+def test_delete_watched_unwatched(tmpdir, monkeypatch):
+    from plexcli import plan
+
+    deleted = []
+    items = dict((k, FakeItem(viewCount=v, delete=lambda k=k: deleted.append(k))) for k, v in ((1, 2), (2, 0)))
+    # Both are watched in the index, 2 has been marked as unwatched since.
+    indexed = [records.Record(ratingKey=k, title='item %s' % k, viewCount=1, parts=()) for k in items]
+    discarded = []
+    idx = FakeItem(records=lambda section_type, watched: indexed, discard=discarded.append)
+
+    c = cli.CLI.__new__(cli.CLI)
+    c._dry_run = False
+    c._max_workers = 2
+    c._get_server = lambda name: FakeItem(fetchItem=items.get)
+    c._index = lambda pms: idx
+    monkeypatch.setattr(cli.click, 'confirm', lambda *args, **kwargs: True)
+    c.delete_watched(use_index=True)
+    assert deleted == discarded == [1]
+
+    # A plan from the index is checked when it's applied too.
+    out = str(tmpdir.join('plan.jsonl'))
+    queries = []
+    applied = []
+    server = FakeItem(machineIdentifier='abc', friendlyName='pms', fetchItem=items.get,
+                      _session=FakeItem(delete=None), query=lambda key, method=None: queries.append(key))
+    c._get_server = lambda name: server
+    c.delete_watched(use_index=True, plan_out=out)
+    assert plan.apply_plan(server, out, callback=lambda o, done: applied.append((o['ratingKey'], done))) == []
+    assert queries == ['/library/metadata/1']
+    assert sorted(applied) == [(1, True), (2, False)]
+
+
+def test_compare():
+    def rec(**kwargs):
+        kwargs.setdefault('type', 'movie')
+        return records.Record(**kwargs)
+
+    mine = [rec(guid='plex://movie/1', title='A', year=2000),
+            rec(guid='local://1', title='B', year=2001),
+            rec(guid='plex://movie/3', title='C', year=2002),
+            rec(type='episode', guid=None, grandparentTitle='Show', parentIndex=1, index=1)]
+    yours = [rec(guid='plex://movie/1', title='A', year=2000),
+             rec(guid='local://9', title='b', year=2001),
+             rec(guid='plex://movie/4', title='D', year=2003),
+             rec(type='episode', guid=None, grandparentTitle='show', parentIndex=1, index=1)]
+    result = [(where, item.title or item.grandparentTitle) for where, item in utils.compare(mine, yours)]
+    assert result == [('both', 'A'), ('both', 'B'), ('mine', 'C'), ('both', 'Show'), ('yours', 'D')]
+
+
+def test_sync_marks(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    assert cache.get_mark('a', 'b', 1) is None
+    cache.set_marks('a', 'b', {1: 100, 2: 200})
+    assert cache.get_mark('a', 'b', 1) == 100
+    assert cache.get_mark('b', 'a', 1) is None
+
+
+def test_sync_targets(tmpdir, monkeypatch, capsys):
+    import socket
+    from plexapi.exceptions import Unauthorized
+    from benchmarks import fakeplex
+
+    class Broken(fakeplex.FakePlex):
+        """Fails to mark anything as watched while broken is True."""
+        broken = True
+
+        def _route(self, method, path, params, query, headers):
+            if self.broken and path == '/:/scrobble':
+                raise KeyError(path)
+            return fakeplex.FakePlex._route(self, method, path, params, query, headers)
+
+    def watched(fake):
+        return set(i['guid'] for i in fake.library.items.values() if i['viewCount'])
+
+    def scrobbles(fake):
+        return fake.requests.get('GET /:/scrobble', 0)
+
+    def login(self):
+        raise Unauthorized('No plex.tv in the tests')
+
+    # Nothing listens on the port of d.
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    dead = 'http://127.0.0.1:%s' % closed.getsockname()[1]
+    closed.close()
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(cli.CLI, '_warm', None)
+    monkeypatch.setattr(cli.CLI, '_login', login)
+    with fakeplex.FakePlex(fakeplex.Library(40, watched=0.5), name='a') as a, \
+            fakeplex.FakePlex(fakeplex.Library(40, watched=0), name='b') as b, \
+            Broken(fakeplex.Library(40, watched=0), name='c') as c:
+        d = {'name': 'd', 'clientIdentifier': 'fake-d', 'accessToken': 'token', 'owned': True, 'uri': dead,
+             'connections': [{'uri': dead, 'local': True, 'relay': False}]}
+        cache.set_resources('user', [a.resource(), b.resource(), c.resource(), d])
+        assert watched(a)
+        cli.CLI(username='user').sync(frm='a', too='b,c,d')
+
+        # c failing and d being down didnt stop b, and only b's marks moved.
+        assert watched(b) == watched(a)
+        # The marks are scrobbled without fetching the items first.
+        assert scrobbles(b) == len(watched(a))
+        assert 'GET /library/metadata/{}' not in b.requests
+        assert not watched(c)
+        assert 'Failed to sync to d' in capsys.readouterr().err
+        sections = (fakeplex.MOVIES, fakeplex.SHOWS)
+        assert all(cache.get_mark(a.machineIdentifier, b.machineIdentifier, s) for s in sections)
+        assert not any(cache.get_mark(a.machineIdentifier, c.machineIdentifier, s) for s in sections)
+        assert not any(cache.get_mark(a.machineIdentifier, 'fake-d', s) for s in sections)
+
+        # a is scanned from c's missing mark, but b only gets what's newer than its own mark.
+        c.broken = False
+        synced = scrobbles(b)
+        cli.CLI(username='user').sync(frm='a', too=('b', 'c'))
+        assert scrobbles(b) == synced
+        assert watched(c) == watched(a)
+
+        # two_way pushes what's been watched on b back to a.
+        fresh = [i for i in b.library.items.values() if not i['viewCount']][:3]
+        for i in fresh:
+            i['viewCount'] = 1
+            i['lastViewedAt'] = int(time.time())
+        cli.CLI(username='user').sync(frm='a', too='b', two_way=True)
+        assert set(i['guid'] for i in fresh) <= watched(a)
+        assert watched(a) == watched(b)
+
+
+def test_plan(tmpdir):
+    from plexcli import executor, plan
+
+    path = str(tmpdir.join('plan.jsonl'))
+    server = FakeItem(machineIdentifier='abc', friendlyName='pms', _session=FakeItem(delete=None))
+    ops = [plan.op(plan.DELETE_MEDIA, 1, 10, '/a.mkv', 100), plan.op(plan.DELETE_ITEM, 2, size=5),
+           plan.op(plan.DELETE_ITEM, 3)]
+    assert plan.write_plan(path, server, ops) == 3
+    header, read = plan.read_plan(path)
+    assert header['server'] == 'abc' and read == ops
+
+    queries = []
+
+    def query(key, method=None):
+        if key.endswith('/3'):
+            raise RuntimeError('boom')
+        queries.append(key)
+
+    server.query = query
+    failed = plan.apply_plan(server, path, executor=executor.AdaptiveExecutor(retries=0))
+    assert sorted(queries) == ['/library/metadata/1/media/10', '/library/metadata/2']
+    assert [o['ratingKey'] for o, _ in failed] == [3]
+    assert plan.read_done(path) == set([0, 1])
+
+    # Resume only runs what's left.
+    del queries[:]
+    server.query = lambda key, method=None: queries.append(key)
+    assert plan.apply_plan(server, path) == []
+    assert queries == ['/library/metadata/3']
+
+
+def test_adaptive_executor():
+    from plexcli import executor
+    from plexapi.exceptions import NotFound
+
+    calls = {}
+
+    def work(i):
+        calls[i] = calls.get(i, 0) + 1
+        if i == 1 and calls[i] < 2:
+            raise IOError('500')
+        if i == 2:
+            raise NotFound('gone')
+        return i
+
+    ex = executor.AdaptiveExecutor(workers=2, max_workers=4, retries=2, backoff=0)
+    result = dict((item, (res, err)) for item, res, err in ex.map(work, range(20)))
+    assert result[1] == (1, None) and calls[1] == 2
+    assert isinstance(result[2][1], NotFound) and calls[2] == 1
+    assert (ex.done, ex.failed) == (19, 1)
+    assert 1 <= ex.limit <= 4
+    assert 'Did 19 operations' in ex.report()
+
+    ex = executor.AdaptiveExecutor(workers=4, retries=0)
+    list(ex.map(lambda i: 1 / 0, range(3)))
+    assert ex.limit == 1
+
+
+def test_executor_deletes():
+    from plexapi.exceptions import BadRequest, NotFound
+    from plexcli import executor
+
+    calls = {}
+
+    def delete(i):
+        calls[i] = calls.get(i, 0) + 1
+        if i == 1:
+            # Deleting is turned off on the server.
+            raise BadRequest('400')
+        if calls[i] == 1:
+            raise IOError('Read timed out')
+        # The first try got through after all.
+        raise NotFound('gone')
+
+    ex = executor.AdaptiveExecutor(retries=3, backoff=0, missing_ok=True)
+    result = dict((item, err) for item, _, err in ex.map(delete, [1, 2]))
+    assert isinstance(result[1], BadRequest) and calls[1] == 1
+    assert result[2] is None and calls[2] == 2
+    assert (ex.done, ex.failed) == (1, 1)
+
+
+def test_pick_free():
+    def c(size, seen=0, rating=None):
+        return {'size': size, 'lastViewedAt': seen, 'rating': rating}
+
+    candidates = [c(10, 3, 8.0), c(50, 1, None), c(30, 2, 5.0), c(5, 4, 2.0)]
+    picked, freed = utils.pick_free(candidates, 40)
+    assert [p['size'] for p in picked] == [50] and freed == 50
+
+    # Oldest first takes 50 then 30, 50 alone is enough so 30 is put back.
+    picked, freed = utils.pick_free(candidates, 45, 'oldest')
+    assert [p['size'] for p in picked] == [50] and freed == 50
+
+    picked, freed = utils.pick_free(candidates, 12, 'rating')
+    assert sorted(p['size'] for p in picked) == [30] and freed == 30
+
+    picked, freed = utils.pick_free(candidates, 1000)
+    assert len(picked) == 4 and freed == 95
+
+    assert utils.timestamp(None) == 0
+    assert utils.timestamp(12) == 12
+    assert records.Record.from_attrib({'ratingKey': '1', 'audienceRating': '7.5'}).rating == 7.5
+
+
+def test_remove_dupes_requests(tmpdir):
+    from plexapi.server import PlexServer
+    from benchmarks import fakeplex
+    from plexcli import plan
+
+    out = str(tmpdir.join('plan.json'))
+    with fakeplex.FakePlex(fakeplex.Library(200, duplicates=0.3)) as fake:
+        pms = PlexServer(fake.url, 'token')
+        c = cli.CLI.__new__(cli.CLI)
+        c._get_server = lambda *args, **kwargs: pms
+        c.remove_dupes(lang='xxx', plan_out=out, free='1TB', priority='oldest')
+
+        ops = plan.read_plan(out)[1]
+        # Unwatched items are in the plan without a reload each, one
+        # batch for the dupes and one for the genres of the shows.
+        assert any(fake.library.items[o['ratingKey']]['lastViewedAt'] is None for o in ops)
+        assert fake.requests['GET /library/metadata/{}'] == 2
+
+
+def test_dedupe(tmpdir):
+    from plexcli import dedupe
+
+    data = os.urandom(2 * 1024 * 1024)
+    for name, content in [('a.mkv', data), ('b.mkv', data), ('c.mkv', data[:-1] + b'x'), ('d.mkv', b'small')]:
+        tmpdir.join(name).write_binary(content)
+
+    path_map = dedupe.parse_path_map('/data=%s,/data/other=/nowhere' % tmpdir)
+    assert path_map[0][0] == '/data/other'
+    assert dedupe.local_path('/data/a.mkv', path_map) == str(tmpdir.join('a.mkv'))
+
+    entries = [(1, '/data/a.mkv', len(data)), (2, '/data/b.mkv', len(data)), (3, '/data/c.mkv', len(data)),
+               (4, '/data/d.mkv', 5), (5, '/data/missing.mkv', len(data))]
+    assert [len(g) for g in dedupe.group_by_size(entries)] == [4]
+
+    groups = dedupe.find_duplicates(entries, path_map, workers=1)
+    assert [sorted(e[0] for c in g for e in c) for g in groups] == [[1, 2]]
+    assert dedupe.find_duplicates(entries, path_map, workers=2) == groups
+
+    # The same file twice, or hard linked, is one copy and not a duplicate.
+    same = str(tmpdir.join('a.mkv'))
+    os.link(same, str(tmpdir.join('link.mkv')))
+    entries = [(1, same, len(data)), (2, same, len(data)), (3, str(tmpdir.join('link.mkv')), len(data))]
+    assert dedupe.find_duplicates(entries, workers=1) == []
+    groups = dedupe.find_duplicates(entries + [(4, str(tmpdir.join('b.mkv')), len(data))], workers=1)
+    assert [sorted(len(c) for c in g) for g in groups] == [[1, 3]]
+
+
+def test_fingerprint_dupes(tmpdir):
+    data = [os.urandom(1024), os.urandom(1024)]
+    files = {}
+    for name, content in [('x', 0), ('x2', 0), ('y', 1), ('y2', 1)]:
+        tmpdir.join(name).write_binary(data[content])
+        files[name] = (str(tmpdir.join(name)), 1024)
+
+    # 2 is a two part media where only cd1 (x2) has a copy elsewhere, 3 is a copy of cd2.
+    # 4 is in another section but it's the same file as 1.
+    layout = {1: [files['x']], 2: [files['x2'], files['y']], 3: [files['y2']], 4: [files['x']]}
+    recs = [records.Record(ratingKey=k, parts=tuple((k * 10,) + f for f in fs)) for k, fs in layout.items()]
+
+    def item(k):
+        media = FakeItem(id=k * 10)
+        return FakeItem(ratingKey=k, key='/library/metadata/%s' % k, media=[media],
+                        iterParts=lambda: [FakeItem(file=layout[k][0][0])])
+
+    def fetch_items(key):
+        return [item(int(k)) for k in key.rsplit('/', 1)[1].split(',')]
+
+    c = cli.CLI.__new__(cli.CLI)
+    c._index = lambda pms: FakeItem(records=lambda section_type: recs)
+    found = c._fingerprint_dupes(FakeItem(fetchItems=fetch_items), use_index=True)
+    # Only 3 goes, 2 would lose y and 4 would lose the file of 1.
+    assert [(i.ratingKey, m.id) for i, m, _ in found] == [(3, 30)]
+
+
+def test_session_table():
+    from plexcli import monitor
+
+    def session(key, user, local, resolution, decision):
+        return FakeItem(sessionKey=key, usernames=[user], title='t%s' % key, viewOffset=0,
+                        players=[FakeItem(title='tv', local=local, state='playing')],
+                        media=[FakeItem(videoResolution=resolution)],
+                        transcodeSessions=[FakeItem(videoDecision=decision)])
+
+    playing = [session(1, 'bob', True, '4k', 'transcode')]
+    calls = []
+    server = FakeItem(sessions=lambda: calls.append(1) or playing)
+    kicked, events = [], []
+    table = monitor.SessionTable(server, monitor.parse_rules('remote transcode 4k;user=eve'),
+                                 kick=lambda info, rule: kicked.append((info['user'], rule)),
+                                 on_change=lambda event, info: events.append((event, info['sessionKey'])))
+    table.sync()
+    assert list(table.sessions) == ['1'] and kicked == []
+
+    def note(key, state):
+        return {'type': 'playing', 'PlaySessionStateNotification': [{'sessionKey': key, 'state': state}]}
+
+    playing.append(session(2, 'al', False, '4k', 'transcode'))
+    table.handle(note('2', 'playing'))
+    assert kicked == [('al', 'remote transcode 4k')]
+
+    # Updates for known sessions dont ask the server.
+    before = len(calls)
+    table.handle(note('1', 'paused'))
+    table.handle(note('2', 'playing'))
+    assert len(calls) == before and kicked == [('al', 'remote transcode 4k')]
+
+    table.handle(note('1', 'stopped'))
+    table.handle({'type': 'timeline'})
+    assert list(table.sessions) == ['2']
+    assert events == [('start', '1'), ('start', '2'), ('update', '1'), ('stop', '1')]
+
+    with pytest.raises(ValueError):
+        monitor.parse_rule('remote foo')
+
+
+def test_listen(caplog):
+    import threading
+    pytest.importorskip('websocket')
+    from plexapi.server import PlexServer
+    from benchmarks import fakeplex
+    from plexcli import monitor
+
+    def wait_for(check, sec=5):
+        end = time.time() + sec
+        while not check() and time.time() < end:
+            time.sleep(0.05)
+        assert check()
+
+    events, kicked, done = [], [], []
+
+    def kick(info, rule):
+        kicked.append(info['user'])
+        info['item'].stop('bye')
+
+    with fakeplex.FakePlex(fakeplex.Library(10)) as fake:
+        pms = PlexServer(fake.url, 'token')
+        table = monitor.SessionTable(pms, monitor.parse_rules('remote'), kick=kick,
+                                     on_change=lambda event, info: events.append((event, info['user'])))
+        t = threading.Thread(target=monitor.listen, args=(pms, table),
+                             kwargs={'retry': 0.1, 'stop': lambda: bool(done)})
+        t.daemon = True
+        t.start()
+
+        wait_for(lambda: fake._sockets)
+        fake.play(1, 1, 'bob')
+        fake.play(2, 2, 'al', local=False)
+        wait_for(lambda: ('stop', 'al') in events)
+        assert kicked == ['al'] and list(fake.sessions) == ['1']
+
+        # A restart drops the websocket and the first resync fails.
+        fake.stop()
+        wait_for(lambda: 'Failed to reconnect' in caplog.text)
+        fake.start()
+        wait_for(lambda: fake._sockets)
+        fake.notify(1, 'stopped')
+        wait_for(lambda: ('stop', 'bob') in events)
+
+        done.append(True)
+        t.join(5)
+        assert not t.is_alive()
+    assert events == [('start', 'bob'), ('start', 'al'), ('stop', 'al'), ('stop', 'bob')]
+
+
+def test_sessions_all_servers():
+    import time
+    from plexcli import monitor
+
+    def session(key, user, decision, bandwidth):
+        return FakeItem(sessionKey=key, usernames=[user], title='t', players=[], media=[],
+                        transcodeSessions=[FakeItem(videoDecision=decision)],
+                        sessions=[FakeItem(bandwidth=bandwidth)])
+
+    servers = {'a': [session(1, 'bob', 'transcode', 4000)], 'b': [session(1, 'al', 'copy', 2000)], 'slow': []}
+
+    def connect(resource, timeout=None):
+        if resource['name'] == 'slow':
+            time.sleep(2)
+        return FakeItem(sessions=lambda: servers[resource['name']])
+
+    c = cli.CLI.__new__(cli.CLI)
+    c._resources = lambda: [{'name': n, 'owned': True} for n in sorted(servers)] + [{'name': 'x', 'owned': False}]
+    c._connect = connect
+    infos = c._sessions(all_servers=True, timeout=0.5)
+    assert sorted((i['server'], i['user']) for i in infos) == [('a', 'bob'), ('b', 'al')]
+    assert monitor.session_totals(infos) == {'sessions': 2, 'transcodes': 1, 'bandwidth': 6000}
+
+
+def test_fake_server():
+    from plexapi.server import PlexServer
+    from benchmarks import fakeplex, run
+
+    with fakeplex.FakePlex(fakeplex.Library(120, duplicates=0.2)) as fake:
+        pms = PlexServer(fake.url, 'token')
+        for section in pms.library.sections():
+            key = utils.section_key(section)
+            assert len(list(records.iter_records(pms, key, page_size=25))) == utils.count_items(pms, key) == 60
+            watched = utils.section_key(section, watched=True)
+            assert all(r.viewCount for r in records.iter_records(pms, watched))
+        assert fake.requests['GET /library/sections/{}/all'] > 6
+
+    result = run.run('sync', items=100)
+    assert result['error'] is None
+    assert result['endpoints']['GET /:/scrobble'] > 0
+
+
+def test_profiler(tmpdir):
+    import json
+    import requests
+    from plexapi.server import PlexServer
+    from benchmarks import fakeplex
+    from plexcli import instrument
+
+    assert instrument.endpoint('GET', 'http://a:32400/library/metadata/1,2,3?x=1') == 'GET a/library/metadata/{}'
+
+    send = requests.Session.send
+    with fakeplex.FakePlex(fakeplex.Library(20)) as fake:
+        profiler = instrument.Profiler().install()
+        pms = PlexServer(fake.url, 'token')
+        utils.fetch_metadata(pms, [1, 2, 3], size=2)
+        table = profiler.report()
+        assert requests.Session.send == send
+
+        profiler.install()
+        pms.query('/library/sections')
+        out = str(tmpdir.join('profile.json'))
+        assert profiler.report(out) is None
+
+    assert 'GET 127.0.0.1/library/metadata/{}' in table
+    data = json.load(open(out))
+    assert data['endpoints']['GET 127.0.0.1/library/metadata/{}']['count'] == 2
+    assert data['requests'] == 4 and data['parse_ms'] >= 0
+
+
+def test_profiler_stream():
+    from plexapi.server import PlexServer
+    from benchmarks import fakeplex
+    from plexcli import instrument, records
+
+    with fakeplex.FakePlex(fakeplex.Library(30)) as fake:
+        pms = PlexServer(fake.url, 'token')
+        profiler = instrument.Profiler().install()
+        try:
+            assert instrument.active() is profiler
+            found = list(records.iter_records(pms, '/library/sections/1/all', page_size=10))
+        finally:
+            profiler.uninstall()
+
+    assert instrument.active() is None
+    assert len(found) == 15
+    stats = profiler.endpoints['GET 127.0.0.1/library/sections/{}/all']
+    # The bodies are read after send returns, they are still counted.
+    assert stats.count == 2 and stats.bytes > 0
+    assert profiler.parse.count == 2 and profiler.parse.bytes == stats.bytes
+
+
+def test_make_session():
+    import threading
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def reply(self):
+            calls.append((self.command, self.client_address[1]))
+            self.send_response(503 if len(calls) < 3 else 200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        do_GET = do_DELETE = reply
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = 'http://127.0.0.1:%s/' % server.server_port
+    try:
+        session = utils.make_session(pool_size=4, retries=3, backoff=0)
+        assert session.get(url).status_code == 200
+        assert [c for c, _ in calls] == ['GET'] * 3
+        # Kept alive, every request used the same connection.
+        assert len(set(port for _, port in calls)) == 1
+
+        del calls[:]
+        assert session.delete(url).status_code == 503
+        assert len(calls) == 1
+    finally:
+        server.shutdown()
+
+
+def test_make_session_blackhole(tmpdir, monkeypatch):
+    import socket
+    from benchmarks import fakeplex
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(cli.CLI, '_warm', None)
+    blackhole = socket.socket()
+    blackhole.bind(('127.0.0.1', 0))
+    blackhole.listen(1)
+    dead = 'http://127.0.0.1:%s' % blackhole.getsockname()[1]
+    try:
+        # A timeout is not retried, a dead address costs one timeout.
+        start = time.time()
+        assert utils.probe(dead, 'token', timeout=0.5, session=utils.make_session(backoff=0)) is None
+        assert time.time() - start < 1.5
+
+        with fakeplex.FakePlex(fakeplex.Library(1), name='a') as fake:
+            resource = fake.resource()
+            resource['uri'] = dead
+            cache.set_resources('user', [resource])
+
+            start = time.time()
+            pms = cli.CLI(username='user')._connect_resource(resource, timeout=0.5)
+            assert time.time() - start < 2
+            assert pms._baseurl == fake.url
+            assert cache.get_resources('user')[0]['uri'] == fake.url
+    finally:
+        blackhole.close()
+
+
+def test_daemon(tmpdir, monkeypatch):
+    import io
+    import threading
+    from benchmarks import fakeplex
+    from plexcli import client, daemon
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(cli.CLI, '_warm', None)
+    path = str(tmpdir.join('d.sock'))
+    assert client.call(['watching'], path) is None
+
+    stop = []
+    with fakeplex.FakePlex(fakeplex.Library(10), name='a') as fake:
+        cache.set_resources('bench', [fake.resource()])
+        t = threading.Thread(target=daemon.serve, args=(path, lambda: stop))
+        t.start()
+        try:
+            for _ in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.05)
+
+            for _ in range(2):
+                out, err = io.StringIO(), io.StringIO()
+                assert client.call(['--username', 'bench', 'watching', '--all_servers'], path, out, err) == 0, err.getvalue()
+                assert '0 streams, 0 transcoding' in out.getvalue()
+
+            # Connected once, the second command used the warm server.
+            assert fake.requests['GET /'] == 1
+            assert fake.requests['GET /status/sessions'] == 2
+
+            # Questions are aborted instead of waiting for an answer.
+            err = io.StringIO()
+            assert client.call(['watching'], path, io.StringIO(), err) == 1
+            assert 'cant ask questions' in err.getvalue()
+        finally:
+            stop.append(1)
+            t.join()
+
+    assert not os.path.exists(path)
+
+
+def test_browser_uses_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(cli.CLI, '_warm', None)
+    cache.set_resources('user', [{'name': 'pms', 'clientIdentifier': 'x', 'uri': None, 'connections': []}])
+    cache.set_uri('user', 'x', 'http://a:32400')
+    # Stale, but still good enough for the browser.
+    data = cache.load(cache.RESOURCES)
+    data['user']['fetched'] = 0
+    cache.save(cache.RESOURCES, data)
+
+    def no_login():
+        raise AssertionError('Asked plex.tv')
+
+    urls = []
+    monkeypatch.setattr(cli.click, 'launch', urls.append)
+    c = cli.CLI(username='user', password='pw')
+    monkeypatch.setattr(c, '_login', no_login)
+    c.browser('pms')
+    assert urls == ['http://a:32400/web/index.html#!/server/x']
+
+
+def test_lazy_imports():
+    import subprocess
+    import sys
+
+    code = ('import sys, plexcli.cli; '
+            'print(" ".join(m for m in ("plexapi", "requests", "tqdm", "fire", "multiprocessing") '
+            'if m in sys.modules))')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == ''